@@ -1,12 +1,39 @@
 import os
 import sqlite3
 import json
-from datetime import datetime
-from flask import Flask, request, jsonify, render_template_string
+import re
+import hashlib
+import gzip
+import bisect
+import weakref
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from flask import Flask, Response, request, jsonify, render_template_string, stream_with_context
 from flask_cors import CORS
+from werkzeug.wsgi import ClosingIterator
 import requests
+import aiohttp
+import asyncio
+import random
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+import threading
+import queue
+import atexit
 import time
 import logging
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed, TimeoutError as FutureTimeoutError
+
+try:
+    import brotli  # Optional: adds a br variant for static assets
+except ImportError:
+    brotli = None
+
+try:
+    import fcntl  # Optional: serializes schema setup across worker processes (Unix only)
+except ImportError:
+    fcntl = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -17,12 +44,101 @@ CORS(app)
 
 # Hugging Face API configuration
 HF_API_KEY = os.getenv('HUGGINGFACE_API_KEY', '')
-HF_API_BASE = "https://api-inference.huggingface.co/models/"
+HF_API_BASE = os.getenv('HF_API_BASE', "https://api-inference.huggingface.co/models/")
+HF_HUB_API_BASE = os.getenv('HF_HUB_API_BASE', "https://huggingface.co/api/models/")
+
+# Connection pool configuration for upstream HTTP calls
+HF_POOL_CONNECTIONS = int(os.getenv('HF_POOL_CONNECTIONS', 4))  # Number of per-host pools kept
+HF_POOL_MAXSIZE = int(os.getenv('HF_POOL_MAXSIZE', 32))  # Keep-alive connections per host
+HF_POOL_BLOCK = os.getenv('HF_POOL_BLOCK', 'false').lower() == 'true'  # Wait for a free connection instead of opening extra ones
 
 # Database configuration
 DATABASE_PATH = 'ai_memory.db'
+DATABASE_SHARDS = int(os.getenv('DATABASE_SHARDS', 1))  # Chat data is hash-partitioned by chat_id across this many files
+DATABASE_BUSY_TIMEOUT = float(os.getenv('DATABASE_BUSY_TIMEOUT', 5.0))  # Seconds to wait on a locked database
+DATABASE_STATEMENT_CACHE = int(os.getenv('DATABASE_STATEMENT_CACHE', 128))  # Prepared statements kept per connection
+
+# Write-behind mode: save_chat_message queues rows for a background batch writer
+WRITE_BEHIND_ENABLED = os.getenv('WRITE_BEHIND_ENABLED', 'false').lower() == 'true'
+WRITE_BEHIND_FLUSH_MS = int(os.getenv('WRITE_BEHIND_FLUSH_MS', 50))  # Max time a row waits before a flush
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv('WRITE_BEHIND_BATCH_SIZE', 100))  # Rows per transaction
+WRITE_BEHIND_QUEUE_SIZE = int(os.getenv('WRITE_BEHIND_QUEUE_SIZE', 10000))  # Above this, writes fall back to synchronous
+
+# In-memory cache of recent per-chat context in front of get_chat_memory
+CONTEXT_CACHE_ENABLED = os.getenv('CONTEXT_CACHE_ENABLED', 'true').lower() == 'true'
+CONTEXT_CACHE_WINDOW = int(os.getenv('CONTEXT_CACHE_WINDOW', 10))  # Most recent rows kept per chat
+CONTEXT_CACHE_MAX_ENTRIES = int(os.getenv('CONTEXT_CACHE_MAX_ENTRIES', 1000))
+CONTEXT_CACHE_MAX_BYTES = int(os.getenv('CONTEXT_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+CONTEXT_CACHE_TTL = float(os.getenv('CONTEXT_CACHE_TTL', 300))  # Seconds; bounds staleness across processes
+
+# Prompt assembly: per-model token budgets (MODELS_CONFIG 'max_input_tokens')
+DEFAULT_MAX_INPUT_TOKENS = int(os.getenv('DEFAULT_MAX_INPUT_TOKENS', 512))
+CONTEXT_MAX_TURNS = int(os.getenv('CONTEXT_MAX_TURNS', 10))  # Upper bound on verbatim history turns
+CHAT_MEMORY_LIMIT = 10  # History rows a chat turn loads for its prompt
+CONTEXT_SUMMARIES_ENABLED = os.getenv('CONTEXT_SUMMARIES_ENABLED', 'false').lower() == 'true'
+CONTEXT_SUMMARY_TOKENS = int(os.getenv('CONTEXT_SUMMARY_TOKENS', 128))  # Budget for the rolling summary of older turns
+
+# Chat history pagination
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', 50))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv('HISTORY_MAX_PAGE_SIZE', 500))
+HISTORY_EXPORT_BATCH = int(os.getenv('HISTORY_EXPORT_BATCH', 500))  # Rows fetched per query when exporting
+
+# Frontend (index.html) served from memory
+INDEX_PATH = os.getenv('INDEX_PATH', 'index.html')
+INDEX_CACHE_CONTROL = os.getenv('INDEX_CACHE_CONTROL', 'no-cache')  # Revalidate with the ETag on every load
+INDEX_RELOAD_INTERVAL = float(os.getenv('INDEX_RELOAD_INTERVAL', 2.0))  # Seconds between mtime checks
+
+# Retention: age/size limits on chat_messages, with optional gzip archives per day
+RETENTION_ENABLED = os.getenv('RETENTION_ENABLED', 'false').lower() == 'true'
+RETENTION_MAX_AGE_DAYS = float(os.getenv('RETENTION_MAX_AGE_DAYS', 0))  # 0 keeps messages forever
+RETENTION_MAX_MESSAGES_PER_CHAT = int(os.getenv('RETENTION_MAX_MESSAGES_PER_CHAT', 0))  # 0 means no cap
+RETENTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE', 500))  # Rows deleted per short write transaction
+RETENTION_BATCH_PAUSE_MS = int(os.getenv('RETENTION_BATCH_PAUSE_MS', 50))  # Gap between batches for other writers
+RETENTION_INTERVAL = float(os.getenv('RETENTION_INTERVAL', 3600))  # Seconds between background passes
+RETENTION_ARCHIVE_DIR = os.getenv('RETENTION_ARCHIVE_DIR', 'archive')  # Empty string deletes without archiving
+RETENTION_VACUUM_PAGES = int(os.getenv('RETENTION_VACUUM_PAGES', 2000))  # Pages freed per incremental_vacuum step
+
+# Full-text search over chat history
+SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', 20))
+SEARCH_MAX_PAGE_SIZE = int(os.getenv('SEARCH_MAX_PAGE_SIZE', 100))
+SEARCH_MAX_OFFSET = int(os.getenv('SEARCH_MAX_OFFSET', 1000))  # Ranked paging gets slower the deeper it goes
+
+# Prometheus-style /metrics
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_LATENCY_BUCKETS = tuple(float(b) for b in os.getenv(
+    'METRICS_LATENCY_BUCKETS', '0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30').split(','))  # Seconds
+
+# Statistics rollups
+STATS_MAX_ROLLUP_HOURS = int(os.getenv('STATS_MAX_ROLLUP_HOURS', 168))  # Longest ?hours= window for /api/stats
+
+# Coalesce concurrent identical upstream calls into one request
+SINGLE_FLIGHT_ENABLED = os.getenv('SINGLE_FLIGHT_ENABLED', 'true').lower() == 'true'
+
+# Local in-process inference for small models (remote API stays the fallback)
+LOCAL_INFERENCE_ENABLED = os.getenv('LOCAL_INFERENCE_ENABLED', 'false').lower() == 'true'
+LOCAL_BACKEND = os.getenv('LOCAL_BACKEND', 'transformers')  # 'transformers' or 'fake' (deterministic, no downloads)
+LOCAL_MODELS = [m.strip() for m in os.getenv('LOCAL_MODELS', 'distilgpt2,gpt2,microsoft/DialoGPT-small').split(',') if m.strip()]
+LOCAL_BATCH_MAX_SIZE = int(os.getenv('LOCAL_BATCH_MAX_SIZE', 8))  # Prompts generated together in one forward pass
+LOCAL_BATCH_MAX_WAIT_MS = float(os.getenv('LOCAL_BATCH_MAX_WAIT_MS', 10))  # How long the first prompt waits for company
+LOCAL_QUEUE_SIZE = int(os.getenv('LOCAL_QUEUE_SIZE', 256))  # Per model; beyond this requests go remote
+LOCAL_TIMEOUT = float(os.getenv('LOCAL_TIMEOUT', 30))  # Seconds before a queued prompt falls back to the remote API
+LOCAL_MAX_NEW_TOKENS = int(os.getenv('LOCAL_MAX_NEW_TOKENS', 64))  # CPU generation is kept short
+LOCAL_FAKE_BATCH_MS = float(os.getenv('LOCAL_FAKE_BATCH_MS', 40))  # Fake model: fixed cost per forward pass
+LOCAL_FAKE_ITEM_MS = float(os.getenv('LOCAL_FAKE_ITEM_MS', 5))  # Fake model: extra cost per prompt in the batch
+
+# Opt-in micro-batching of concurrent upstream calls to the same model (inputs sent as a list)
+UPSTREAM_BATCH_ENABLED = os.getenv('UPSTREAM_BATCH_ENABLED', 'false').lower() == 'true'
+UPSTREAM_BATCH_WINDOW_MS = float(os.getenv('UPSTREAM_BATCH_WINDOW_MS', 5))  # How long the first prompt waits for others
+UPSTREAM_BATCH_MAX_SIZE = int(os.getenv('UPSTREAM_BATCH_MAX_SIZE', 8))
+
+# Opt-in cache of upstream responses for identical (model, prompt, parameters)
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'false').lower() == 'true'
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', 3600))  # Seconds
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 500))  # In-memory tier
+RESPONSE_CACHE_DB_MAX_ROWS = int(os.getenv('RESPONSE_CACHE_DB_MAX_ROWS', 10000))  # SQLite tier
+RESPONSE_CACHE_ALLOW_SAMPLED = os.getenv('RESPONSE_CACHE_ALLOW_SAMPLED', 'false').lower() == 'true'  # Cache do_sample=True generations too
 
-# Model configurations with speed categories and power ratings
+# Model configurations with speed categories, power ratings and prompt token budgets
 MODELS_CONFIG = {
     # Lightning Fast - Smaller, faster models (WORKING MODELS)
     "distilgpt2": {
@@ -30,21 +146,24 @@ MODELS_CONFIG = {
         "category": "lightning", 
         "power": 1,
         "description": "Lightweight version of GPT-2",
-        "specs": "82M params • General purpose • Very fast"
+        "specs": "82M params • General purpose • Very fast",
+        "max_input_tokens": 512
     },
     "gpt2": {
         "name": "GPT-2",
         "category": "lightning",
         "power": 2,
         "description": "OpenAI's GPT-2 model for text generation",
-        "specs": "124M params • Text generation • Reliable"
+        "specs": "124M params • Text generation • Reliable",
+        "max_input_tokens": 512
     },
     "microsoft/DialoGPT-small": {
         "name": "DialoGPT Small",
         "category": "lightning",
         "power": 1,
         "description": "Fast conversational AI model",
-        "specs": "117M params • Conversational • Fast inference"
+        "specs": "117M params • Conversational • Fast inference",
+        "max_input_tokens": 512
     },
     
     # Balanced Performance (WORKING MODELS)
@@ -53,21 +172,24 @@ MODELS_CONFIG = {
         "category": "balanced",
         "power": 2,
         "description": "Balanced conversational model",
-        "specs": "345M params • Conversational • Good balance"
+        "specs": "345M params • Conversational • Good balance",
+        "max_input_tokens": 512
     },
     "facebook/blenderbot-400M-distill": {
         "name": "BlenderBot 400M",
         "category": "balanced",
         "power": 2,
         "description": "Facebook's conversational AI",
-        "specs": "400M params • Conversational • Engaging"
+        "specs": "400M params • Conversational • Engaging",
+        "max_input_tokens": 128
     },
     "microsoft/codebert-base": {
         "name": "CodeBERT Base",
         "category": "balanced",
         "power": 2,
         "description": "Microsoft's code understanding model",
-        "specs": "125M params • Code-focused • Versatile"
+        "specs": "125M params • Code-focused • Versatile",
+        "max_input_tokens": 512
     },
     
     # Maximum Power (WORKING MODELS)
@@ -76,21 +198,24 @@ MODELS_CONFIG = {
         "category": "power",
         "power": 3,
         "description": "Large conversational model with high quality responses",
-        "specs": "762M params • High quality • Conversational"
+        "specs": "762M params • High quality • Conversational",
+        "max_input_tokens": 512
     },
     "facebook/blenderbot-1B-distill": {
         "name": "BlenderBot 1B",
         "category": "power", 
         "power": 3,
         "description": "Large-scale conversational AI",
-        "specs": "1B params • Advanced conversation • High quality"
+        "specs": "1B params • Advanced conversation • High quality",
+        "max_input_tokens": 128
     },
     "EleutherAI/gpt-neo-1.3B": {
         "name": "GPT-Neo 1.3B",
         "category": "power",
         "power": 3,
         "description": "Large language model for complex tasks",
-        "specs": "1.3B params • Advanced reasoning • High quality"
+        "specs": "1.3B params • Advanced reasoning • High quality",
+        "max_input_tokens": 1536
     },
     
     # ORIGINAL MODEL FOR TESTING (keeping one as requested)
@@ -99,10 +224,607 @@ MODELS_CONFIG = {
         "category": "lightning",
         "power": 1,
         "description": "Ultra-fast lightweight model for quick code suggestions (ORIGINAL - FOR TESTING)",
-        "specs": "1.3B params • Instruct-tuned • Multi-language • MAY NOT WORK"
+        "specs": "1.3B params • Instruct-tuned • Multi-language • MAY NOT WORK",
+        "max_input_tokens": 4096
     }
 }
 
+class Histogram:
+    """Prometheus-style histogram, sharded per thread so observe() never takes a lock
+
+    Each thread only ever writes its own shard (keyed by thread ident, which
+    is unique among live threads), and collect() sums the shards.
+    """
+
+    def __init__(self, name, documentation, labelnames=(), buckets=METRICS_LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._children = {}  # label values -> {thread ident: [bucket counts..., +Inf count, sum]}
+        self._lock = threading.Lock()  # Only taken when a new label set or thread shows up
+
+    def observe(self, value, *labelvalues):
+        if not METRICS_ENABLED:
+            return
+        shards = self._children.get(labelvalues)
+        if shards is None:
+            with self._lock:
+                shards = self._children.setdefault(labelvalues, {})
+        ident = threading.get_ident()
+        shard = shards.get(ident)
+        if shard is None:
+            with self._lock:
+                shard = shards.setdefault(ident, [0] * (len(self.buckets) + 1) + [0.0])
+        shard[bisect.bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    @contextmanager
+    def time(self, *labelvalues):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labelvalues)
+
+    def collect(self):
+        """Yield (labelvalues, cumulative bucket counts, count, sum) per label set"""
+        for labelvalues, shards in list(self._children.items()):
+            totals = [0] * (len(self.buckets) + 1)
+            total_sum = 0.0
+            for shard in list(shards.values()):
+                for index in range(len(totals)):
+                    totals[index] += shard[index]
+                total_sum += shard[-1]
+            cumulative = []
+            running = 0
+            for count in totals:
+                running += count
+                cumulative.append(running)
+            yield labelvalues, cumulative, running, total_sum
+
+class Counter:
+    """Monotonic counter with the same per-thread sharding as Histogram"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}  # label values -> {thread ident: [count]}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount=1):
+        if not METRICS_ENABLED:
+            return
+        shards = self._children.get(labelvalues)
+        if shards is None:
+            with self._lock:
+                shards = self._children.setdefault(labelvalues, {})
+        shard = shards.get(threading.get_ident())
+        if shard is None:
+            with self._lock:
+                shard = shards.setdefault(threading.get_ident(), [0])
+        shard[0] += amount
+
+    def collect(self):
+        for labelvalues, shards in list(self._children.items()):
+            yield labelvalues, sum(shard[0] for shard in list(shards.values()))
+
+class MetricsRegistry:
+    """Holds the process metrics and renders them in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = []
+        self._gauges = []  # (name, documentation, callback returning a number)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=METRICS_LATENCY_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name, documentation, callback):
+        self._gauges.append((name, documentation, callback))
+
+    @staticmethod
+    def _labels(names, values, extra=None):
+        pairs = list(zip(names, values))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+        return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            if isinstance(metric, Histogram):
+                lines.append(f'# TYPE {metric.name} histogram')
+                for labelvalues, cumulative, count, total in metric.collect():
+                    for bound, value in zip(metric.buckets + (float('inf'),), cumulative):
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append(f'{metric.name}_bucket{self._labels(metric.labelnames, labelvalues, ("le", le))} {value}')
+                    lines.append(f'{metric.name}_sum{self._labels(metric.labelnames, labelvalues)} {total}')
+                    lines.append(f'{metric.name}_count{self._labels(metric.labelnames, labelvalues)} {count}')
+            else:
+                lines.append(f'# TYPE {metric.name} counter')
+                for labelvalues, value in metric.collect():
+                    lines.append(f'{metric.name}{self._labels(metric.labelnames, labelvalues)} {value}')
+        for name, documentation, callback in self._gauges:
+            try:
+                value = callback()
+            except Exception as e:
+                logger.error(f"Metrics gauge {name} failed: {str(e)}")
+                continue
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+DB_READ_SECONDS = metrics.histogram('db_read_seconds', 'SQLite read time by query', ('query',))
+DB_WRITE_SECONDS = metrics.histogram('db_write_seconds', 'SQLite write transaction time by write path', ('path',))
+UPSTREAM_REQUEST_SECONDS = metrics.histogram(
+    'upstream_request_seconds', 'Inference API response time by model and status', ('model', 'status'))
+UPSTREAM_RETRIES = metrics.counter('upstream_retries_total', 'Upstream retries by model and reason', ('model', 'reason'))
+HTTP_REQUEST_SECONDS = metrics.histogram(
+    'http_request_seconds', 'Time to build the response, by route and status', ('endpoint', 'method', 'status'))
+
+class PoolMetrics:
+    """Thread-safe per-host counters for the upstream connection pools"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def record(self, host, event):
+        with self._lock:
+            counters = self._hosts.setdefault(host, {'requests': 0, 'new_connections': 0, 'waits': 0})
+            counters[event] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                host: dict(counters, hits=max(counters['requests'] - counters['new_connections'], 0))
+                for host, counters in self._hosts.items()
+            }
+
+def _metered_pool_class(base, metrics):
+    """Build a urllib3 pool class that reports reuse, new connections and waits"""
+
+    class MeteredConnectionPool(base):
+        def _get_conn(self, timeout=None):
+            metrics.record(self.host, 'requests')
+            if self.block and self.pool is not None and self.pool.empty():
+                metrics.record(self.host, 'waits')
+            return super()._get_conn(timeout=timeout)
+
+        def _new_conn(self):
+            metrics.record(self.host, 'new_connections')
+            return super()._new_conn()
+
+    MeteredConnectionPool.__name__ = f"Metered{base.__name__}"
+    return MeteredConnectionPool
+
+class MeteredHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose connection pools feed a PoolMetrics instance"""
+
+    def __init__(self, metrics, **kwargs):
+        self.metrics = metrics
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _metered_pool_class(HTTPConnectionPool, self.metrics),
+            'https': _metered_pool_class(HTTPSConnectionPool, self.metrics),
+        }
+
+class InferenceClient:
+    """Shared keep-alive HTTP client for the Hugging Face APIs"""
+
+    def __init__(self, api_key, pool_connections=HF_POOL_CONNECTIONS, pool_maxsize=HF_POOL_MAXSIZE, pool_block=HF_POOL_BLOCK):
+        self.api_key = api_key
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.metrics = PoolMetrics()
+        self.auth_headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        }
+        
+        adapter = MeteredHTTPAdapter(
+            self.metrics,
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block,
+            max_retries=0  # Retries are handled by the callers
+        )
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def post(self, url, **kwargs):
+        """POST with the pre-built auth headers over a pooled connection"""
+        return self.session.post(url, headers=self.auth_headers, **kwargs)
+
+    def get(self, url, authenticated=False, **kwargs):
+        """GET over a pooled connection, optionally authenticated"""
+        headers = self.auth_headers if authenticated else None
+        return self.session.get(url, headers=headers, **kwargs)
+
+    def get_metrics(self):
+        """Pool configuration and per-host reuse counters"""
+        return {
+            'pool_maxsize': self.pool_maxsize,
+            'pool_block': self.pool_block,
+            'hosts': self.metrics.snapshot()
+        }
+
+    def close(self):
+        self.session.close()
+
+# Shared client used by every upstream call
+inference_client = InferenceClient(HF_API_KEY)
+
+# Model sweep (/api/test/all, /api/debug/all) configuration
+FANOUT_CONCURRENCY = int(os.getenv('FANOUT_CONCURRENCY', 4))  # Models probed at once
+FANOUT_MAX_CONCURRENCY = int(os.getenv('FANOUT_MAX_CONCURRENCY', 10))  # Cap for the ?concurrency= override
+FANOUT_RATE = float(os.getenv('FANOUT_RATE', 2.0))  # Upstream calls started per second across all sweeps
+FANOUT_BURST = int(os.getenv('FANOUT_BURST', 4))
+
+class TokenBucket:
+    """Thread-safe token bucket rate limiter"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self):
+        """Take a token if one is available; returns the seconds to wait otherwise"""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self, timeout=None):
+        """Block until a token is available; False if timeout expires first"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire()
+            if wait == 0:
+                return True
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
+
+# Shared by every sweep so parallel sweeps cannot exceed the rate together
+fanout_bucket = TokenBucket(FANOUT_RATE, FANOUT_BURST)
+
+# Client-side admission control for upstream calls
+ADMISSION_ENABLED = os.getenv('ADMISSION_ENABLED', 'true').lower() == 'true'
+ADMISSION_RATE = float(os.getenv('ADMISSION_RATE', 10))  # Upstream calls started per second, all models
+ADMISSION_BURST = int(os.getenv('ADMISSION_BURST', 20))
+ADMISSION_QUEUE_SIZE = int(os.getenv('ADMISSION_QUEUE_SIZE', 32))  # Waiters per model before fast rejection
+ADMISSION_MAX_WAIT = float(os.getenv('ADMISSION_MAX_WAIT', 10))  # Seconds a call may wait for admission
+ADMISSION_SLOTS_BY_POWER = {1: 8, 2: 4, 3: 2}  # Concurrent calls per model; MODELS_CONFIG 'max_concurrency' overrides
+
+class AdmissionRejected(Exception):
+    """An upstream call could not be admitted (queue full, deadline or rate limit)"""
+
+    def __init__(self, model_name, reason, retry_after=1):
+        super().__init__(f"Upstream call to {model_name} rejected: {reason}")
+        self.model_name = model_name
+        self.reason = reason
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """Global token bucket plus bounded per-model concurrency with a deadline-aware queue"""
+
+    def __init__(self, bucket, queue_size=ADMISSION_QUEUE_SIZE, max_wait=ADMISSION_MAX_WAIT, slots_by_power=ADMISSION_SLOTS_BY_POWER):
+        self.bucket = bucket
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.slots_by_power = slots_by_power
+        self._cond = threading.Condition()
+        self._active = {}
+        self._waiting = {}
+        self._async_slots = {}  # model -> asyncio.Semaphore for the event-loop path
+        self._async_waiting = {}
+        self._async_active = {}
+        self.stats = {
+            'admitted': 0,
+            'rejected_queue_full': 0,
+            'rejected_timeout': 0,
+            'rejected_rate_limited': 0,
+            'total_wait_ms': 0.0,
+            'max_wait_ms': 0.0
+        }
+
+    def limit_for(self, model_name):
+        config = MODELS_CONFIG.get(model_name, {})
+        return config.get('max_concurrency') or self.slots_by_power.get(config.get('power'), 2)
+
+    @contextmanager
+    def admit(self, model_name, timeout=None):
+        """Hold a model slot and a rate token for the duration of the block"""
+        start = time.monotonic()
+        deadline = start + (self.max_wait if timeout is None else timeout)
+        limit = self.limit_for(model_name)
+        
+        with self._cond:
+            if self._active.get(model_name, 0) >= limit:
+                if self._waiting.get(model_name, 0) >= self.queue_size:
+                    self.stats['rejected_queue_full'] += 1
+                    raise AdmissionRejected(model_name, 'queue_full')
+                self._waiting[model_name] = self._waiting.get(model_name, 0) + 1
+                try:
+                    while self._active.get(model_name, 0) >= limit:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.stats['rejected_timeout'] += 1
+                            raise AdmissionRejected(model_name, 'timeout')
+                        self._cond.wait(remaining)
+                finally:
+                    self._waiting[model_name] -= 1
+            self._active[model_name] = self._active.get(model_name, 0) + 1
+        
+        try:
+            if not self.bucket.acquire(timeout=max(deadline - time.monotonic(), 0)):
+                with self._cond:
+                    self.stats['rejected_rate_limited'] += 1
+                raise AdmissionRejected(model_name, 'rate_limited', retry_after=1 / max(self.bucket.rate, 0.001))
+            
+            waited_ms = (time.monotonic() - start) * 1000
+            with self._cond:
+                self.stats['admitted'] += 1
+                self.stats['total_wait_ms'] += waited_ms
+                self.stats['max_wait_ms'] = max(self.stats['max_wait_ms'], waited_ms)
+            yield
+        finally:
+            with self._cond:
+                self._active[model_name] -= 1
+                self._cond.notify_all()
+
+    @asynccontextmanager
+    async def admit_async(self, model_name, timeout=None):
+        """asyncio counterpart of admit(): per-model semaphore slots and the shared rate bucket, without blocking the loop"""
+        start = time.monotonic()
+        deadline = start + (self.max_wait if timeout is None else timeout)
+        slots = self._async_slots.get(model_name)
+        if slots is None:
+            slots = self._async_slots[model_name] = asyncio.Semaphore(self.limit_for(model_name))
+        
+        queued = slots.locked()
+        if queued:
+            with self._cond:
+                if self._async_waiting.get(model_name, 0) >= self.queue_size:
+                    self.stats['rejected_queue_full'] += 1
+                    raise AdmissionRejected(model_name, 'queue_full')
+                self._async_waiting[model_name] = self._async_waiting.get(model_name, 0) + 1
+        try:
+            await asyncio.wait_for(slots.acquire(), max(deadline - time.monotonic(), 0.001))
+        except asyncio.TimeoutError:
+            with self._cond:
+                self.stats['rejected_timeout'] += 1
+            raise AdmissionRejected(model_name, 'timeout')
+        finally:
+            if queued:
+                with self._cond:
+                    self._async_waiting[model_name] -= 1
+        
+        try:
+            while True:
+                wait = self.bucket.try_acquire()
+                if wait == 0:
+                    break
+                if time.monotonic() + wait > deadline:
+                    with self._cond:
+                        self.stats['rejected_rate_limited'] += 1
+                    raise AdmissionRejected(model_name, 'rate_limited', retry_after=1 / max(self.bucket.rate, 0.001))
+                await asyncio.sleep(wait)
+            
+            waited_ms = (time.monotonic() - start) * 1000
+            with self._cond:
+                self.stats['admitted'] += 1
+                self.stats['total_wait_ms'] += waited_ms
+                self.stats['max_wait_ms'] = max(self.stats['max_wait_ms'], waited_ms)
+                self._async_active[model_name] = self._async_active.get(model_name, 0) + 1
+            try:
+                yield
+            finally:
+                with self._cond:
+                    self._async_active[model_name] -= 1
+        finally:
+            slots.release()
+
+    def get_stats(self):
+        with self._cond:
+            stats = dict(self.stats)
+            stats['avg_wait_ms'] = round(stats['total_wait_ms'] / stats['admitted'], 2) if stats['admitted'] else 0.0
+            stats['total_wait_ms'] = round(stats['total_wait_ms'], 1)
+            stats['max_wait_ms'] = round(stats['max_wait_ms'], 1)
+            stats['queue_depth'] = sum(self._waiting.values()) + sum(self._async_waiting.values())
+            stats['models'] = {
+                model_name: {
+                    'active': self._active.get(model_name, 0),
+                    'waiting': self._waiting.get(model_name, 0),
+                    'limit': self.limit_for(model_name)
+                }
+                for model_name in set(self._active) | set(self._waiting)
+            }
+            stats['async_models'] = {
+                model_name: {
+                    'active': self._async_active.get(model_name, 0),
+                    'waiting': self._async_waiting.get(model_name, 0)
+                }
+                for model_name in self._async_slots
+            }
+            return stats
+
+admission_controller = AdmissionController(TokenBucket(ADMISSION_RATE, ADMISSION_BURST)) if ADMISSION_ENABLED else None
+
+def upstream_admission(model_name):
+    """Admission context for one upstream call (no-op when admission control is off)"""
+    return admission_controller.admit(model_name) if admission_controller else nullcontext()
+
+def async_upstream_admission(model_name):
+    """Async admission context for one upstream call on the event loop"""
+    return admission_controller.admit_async(model_name) if admission_controller else nullcontext()
+
+# Per-model circuit breakers for the chat path
+BREAKER_ENABLED = os.getenv('BREAKER_ENABLED', 'true').lower() == 'true'
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', 5))  # Consecutive failures before opening
+BREAKER_RESET_TIMEOUT = float(os.getenv('BREAKER_RESET_TIMEOUT', 30))  # Seconds open before a half-open probe
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker for one model"""
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started = None
+        self.times_opened = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_failure(status_code):
+        """Not found, server errors and timeouts (None) count; 4xx like 429 do not"""
+        return status_code is None or status_code == 404 or status_code >= 500
+
+    def allow(self):
+        """Whether a request may go upstream; in half-open only one probe at a time"""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and now - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.probe_started = None
+            if self.state == self.HALF_OPEN:
+                # A probe that never reported back (e.g. rejected by admission) expires
+                if self.probe_started is None or now - self.probe_started >= self.reset_timeout:
+                    self.probe_started = now
+                    return True
+            self.rejected += 1
+            return False
+
+    def record(self, status_code):
+        with self._lock:
+            if status_code == 200:
+                self.state = self.CLOSED
+                self.failures = 0
+                self.probe_started = None
+            elif self.is_failure(status_code):
+                self.failures += 1
+                if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                    if self.state != self.OPEN:
+                        self.times_opened += 1
+                    self.state = self.OPEN
+                    self.opened_at = time.monotonic()
+                    self.probe_started = None
+            elif self.state == self.HALF_OPEN:
+                self.probe_started = None  # Inconclusive probe (e.g. 429); let another one through
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.failures,
+                'times_opened': self.times_opened,
+                'rejected': self.rejected,
+                'retry_in_seconds': round(max(self.reset_timeout - (time.monotonic() - self.opened_at), 0), 1) if self.state == self.OPEN else None
+            }
+
+class CircuitBreakerRegistry:
+    """Lazily created breaker per model"""
+
+    def __init__(self, **breaker_kwargs):
+        self._breakers = {}
+        self._lock = threading.Lock()
+        self._breaker_kwargs = breaker_kwargs
+
+    def get(self, model_name):
+        with self._lock:
+            breaker = self._breakers.get(model_name)
+            if breaker is None:
+                breaker = self._breakers[model_name] = CircuitBreaker(**self._breaker_kwargs)
+            return breaker
+
+    def allow(self, model_name):
+        return self.get(model_name).allow()
+
+    def is_open(self, model_name):
+        with self._lock:
+            breaker = self._breakers.get(model_name)
+        return breaker is not None and breaker.snapshot()['state'] == CircuitBreaker.OPEN
+
+    def record(self, model_name, status_code):
+        self.get(model_name).record(status_code)
+
+    def snapshot(self):
+        with self._lock:
+            breakers = dict(self._breakers)
+        return {model_name: breaker.snapshot() for model_name, breaker in breakers.items()}
+
+circuit_breakers = CircuitBreakerRegistry() if BREAKER_ENABLED else None
+
+def breaker_allows(model_name):
+    return circuit_breakers is None or circuit_breakers.allow(model_name)
+
+def breaker_open_reply(model_name):
+    return f"The AI model '{model_name}' is temporarily unavailable after repeated failures. Please try again shortly."
+
+def record_upstream_outcome(model_name, status_code, latency=None):
+    """Feed one upstream result (None for timeouts/connection errors) to the monitor and breaker"""
+    model_monitor.observe(model_name, status_code, latency)
+    if latency is not None:
+        UPSTREAM_REQUEST_SECONDS.observe(latency, model_name, str(status_code) if status_code is not None else 'error')
+    if circuit_breakers is not None:
+        circuit_breakers.record(model_name, status_code)
+
+# Background model health prober and warm-up scheduler
+MODEL_PROBER_ENABLED = os.getenv('MODEL_PROBER_ENABLED', 'false').lower() == 'true'
+MODEL_PROBE_INTERVAL = float(os.getenv('MODEL_PROBE_INTERVAL', 300))  # Seconds between full probe sweeps
+MODEL_WARM_INTERVAL = float(os.getenv('MODEL_WARM_INTERVAL', 60))  # Seconds between warm-up pings
+MODEL_WARM_TOP_N = int(os.getenv('MODEL_WARM_TOP_N', 3))  # Most used models kept warm
+MODEL_STATUS_TTL = float(os.getenv('MODEL_STATUS_TTL', 600))  # Older observations are reported as unknown
+MODEL_FAIL_FAST = os.getenv('MODEL_FAIL_FAST', 'false').lower() == 'true'  # Skip retry sleeps for models known to be down
+MODEL_FAIL_FAST_WINDOW = float(os.getenv('MODEL_FAIL_FAST_WINDOW', 30))  # Seconds a loading/not-found observation is trusted
+
+# Latency-aware routing within a speed category
+ROUTING_EWMA_ALPHA = float(os.getenv('ROUTING_EWMA_ALPHA', 0.3))  # Weight of the newest observation
+ROUTING_DEFAULT_LATENCY = float(os.getenv('ROUTING_DEFAULT_LATENCY', 5.0))  # Seconds assumed for unobserved models
+MODEL_CATEGORIES = ('lightning', 'balanced', 'power')
+
+# Async chat path configuration
+ASYNC_MAX_CONNECTIONS = int(os.getenv('ASYNC_MAX_CONNECTIONS', 500))  # In-flight upstream calls on the event loop
+ASYNC_REQUEST_TIMEOUT = int(os.getenv('ASYNC_REQUEST_TIMEOUT', 120))  # Seconds a Flask worker waits for an async turn
+
 def debug_huggingface_api(model_name):
     """Debug function to check API connectivity and model availability"""
     # Check if API key is set
@@ -115,15 +837,12 @@ def debug_huggingface_api(model_name):
         }
     
     # Test API connectivity
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
+    client = inference_client if api_key == inference_client.api_key else InferenceClient(api_key)
     
     # First, try to get model info
-    model_info_url = f"https://huggingface.co/api/models/{model_name}"
+    model_info_url = f"{HF_HUB_API_BASE}{model_name}"
     try:
-        info_response = requests.get(model_info_url, timeout=10)
+        info_response = client.get(model_info_url, timeout=10)
         logger.info(f"Model info status for {model_name}: {info_response.status_code}")
         
         if info_response.status_code == 404:
@@ -140,7 +859,7 @@ def debug_huggingface_api(model_name):
         logger.error(f"Error checking model info for {model_name}: {e}")
     
     # Test inference endpoint
-    inference_url = f"https://api-inference.huggingface.co/models/{model_name}"
+    inference_url = f"{HF_API_BASE}{model_name}"
     test_payload = {
         "inputs": "Hello, how are you?",
         "parameters": {
@@ -152,7 +871,7 @@ def debug_huggingface_api(model_name):
     }
     
     try:
-        response = requests.post(inference_url, headers=headers, json=test_payload, timeout=30)
+        response = client.post(inference_url, json=test_payload, timeout=30)
         
         result = {
             'model': model_name,
@@ -182,9 +901,144 @@ def debug_huggingface_api(model_name):
             'api_key_set': bool(api_key and len(api_key) > 10)
         }
 
+def shard_paths(shards=None, base_path=None):
+    """Database file of every shard; a single shard is DATABASE_PATH itself"""
+    shards = DATABASE_SHARDS if shards is None else shards
+    base_path = base_path or DATABASE_PATH
+    if shards <= 1:
+        return [base_path]
+    base, ext = os.path.splitext(base_path)
+    return [f"{base}-{index}-of-{shards}{ext}" for index in range(shards)]
+
+def shard_index(chat_id, shards=None):
+    """Stable shard number for chat_id (independent of PYTHONHASHSEED)"""
+    shards = DATABASE_SHARDS if shards is None else shards
+    if shards <= 1:
+        return 0
+    digest = hashlib.blake2b(str(chat_id).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % shards
+
+def shard_path(chat_id):
+    return shard_paths()[shard_index(chat_id)]
+
+def _close_connections(connections):
+    for conn in connections.values():
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+    connections.clear()
+
+class _ThreadConnections:
+    """One thread's connections by path; closed when the thread exits and its thread-local is dropped"""
+
+    def __init__(self):
+        self.connections = {}
+        self.finalizer = weakref.finalize(self, _close_connections, self.connections)
+
+class SQLiteConnectionPool:
+    """Per-thread persistent SQLite connections in WAL mode
+
+    Threaded servers start a thread per client connection, so a thread's
+    connections are closed when that thread exits; the pool only keeps weak
+    references to them.
+    """
+
+    def __init__(self, busy_timeout=DATABASE_BUSY_TIMEOUT, cached_statements=DATABASE_STATEMENT_CACHE):
+        self.busy_timeout = busy_timeout
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._threads = weakref.WeakSet()
+        self.opened = 0
+
+    def get_connection(self, path=None):
+        """Return this thread's connection to path (defaults to the first shard, home of response_cache)"""
+        path = path or shard_paths()[0]
+        holder = getattr(self._local, 'holder', None)
+        if holder is None:
+            holder = self._local.holder = _ThreadConnections()
+            with self._lock:
+                self._threads.add(holder)
+        
+        conn = holder.connections.get(path)
+        if conn is None:
+            conn = self._open(path)
+            holder.connections[path] = conn
+        return conn
+
+    def open_connections(self):
+        with self._lock:
+            return sum(len(holder.connections) for holder in self._threads)
+
+    def _open(self, path):
+        conn = sqlite3.connect(
+            path,
+            timeout=self.busy_timeout,
+            cached_statements=self.cached_statements,
+            check_same_thread=False  # Only closed from another thread by close_all()
+        )
+        # Must precede the switch to WAL; existing files need a one-off VACUUM to pick it up
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout * 1000)}')
+        with self._lock:
+            self.opened += 1
+        return conn
+
+    def close_all(self):
+        """Close every connection still open (e.g. on shutdown or in benchmarks)"""
+        with self._lock:
+            holders, self._threads = list(self._threads), weakref.WeakSet()
+        for holder in holders:
+            holder.finalizer()
+        self._local = threading.local()
+
+db_pool = SQLiteConnectionPool()
+
+def chat_connection(chat_id):
+    """Pooled connection to the shard holding chat_id"""
+    return db_pool.get_connection(shard_path(chat_id))
+
+def shard_connections():
+    """Pooled connections to every shard, for queries that fan out"""
+    return [db_pool.get_connection(path) for path in shard_paths()]
+
+database_ready = False
+_database_ready_lock = threading.Lock()
+
 def init_database():
-    """Initialize SQLite database for AI memory"""
-    conn = sqlite3.connect(DATABASE_PATH)
+    """Initialize SQLite database for AI memory (every shard gets the same schema)"""
+    global database_ready
+    for path in shard_paths():
+        init_schema(db_pool.get_connection(path))
+    database_ready = True
+    logger.info(f"Database initialized successfully ({len(shard_paths())} shard(s))")
+
+@contextmanager
+def database_init_lock():
+    """Exclusive file lock next to the first shard, so concurrent processes migrate one at a time"""
+    if fcntl is None:
+        yield
+        return
+    with open(f"{shard_paths()[0]}.init-lock", 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def ensure_database():
+    """Run init_database() once per process, under the cross-process lock (cheap once done)"""
+    if database_ready:
+        return
+    with _database_ready_lock:
+        if not database_ready:
+            with database_init_lock():
+                init_database()
+
+def init_schema(conn):
     cursor = conn.cursor()
     
     # Create chat_sessions table
@@ -206,199 +1060,2323 @@ def init_database():
             user_message TEXT NOT NULL,
             bot_response TEXT NOT NULL,
             timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            latency_ms REAL,
             FOREIGN KEY (chat_id) REFERENCES chat_sessions (id)
         )
     ''')
     
+    # Databases created before latency tracking lack the column
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(chat_messages)')]
+    if 'latency_ms' not in columns:
+        cursor.execute('ALTER TABLE chat_messages ADD COLUMN latency_ms REAL')
+    
     # Create indexes for better performance
+    # (chat_id, id) serves per-chat lookups and keyset pagination; it supersedes
+    # the old single-column chat_id index
     cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_chat_messages_chat_id ON chat_messages(chat_id)
+        CREATE INDEX IF NOT EXISTS idx_chat_messages_chat_id_id ON chat_messages(chat_id, id)
     ''')
+    cursor.execute('DROP INDEX IF EXISTS idx_chat_messages_chat_id')
     
     cursor.execute('''
         CREATE INDEX IF NOT EXISTS idx_chat_messages_timestamp ON chat_messages(timestamp)
     ''')
     
-    conn.commit()
-    conn.close()
-    logger.info("Database initialized successfully")
-
-def get_chat_memory(chat_id, limit=10):
-    """Retrieve recent chat history for context"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
+    # Create response_cache table (persistent tier of ResponseCache)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS response_cache (
+            key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            response TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            last_used REAL NOT NULL
+        )
+    ''')
     
     cursor.execute('''
-        SELECT user_message, bot_response, timestamp 
-        FROM chat_messages 
-        WHERE chat_id = ? 
-        ORDER BY timestamp DESC 
-        LIMIT ?
-    ''', (chat_id, limit))
+        CREATE INDEX IF NOT EXISTS idx_response_cache_last_used ON response_cache(last_used)
+    ''')
+    
+    # Create chat_summaries table (rolling summaries of turns older than the history window)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_summaries (
+            chat_id TEXT PRIMARY KEY,
+            summary TEXT NOT NULL,
+            summarized_through INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
     
-    messages = cursor.fetchall()
-    conn.close()
+    conn.commit()
     
-    # Reverse to get chronological order
-    return list(reversed(messages))
+    init_stats_tables(conn)
+    init_search_index(conn)
 
-def save_chat_message(chat_id, model, user_message, bot_response):
-    """Save chat message to database"""
-    conn = sqlite3.connect(DATABASE_PATH)
+search_available = False  # Set by init_search_index when this SQLite build has FTS5
+
+def init_search_index(conn):
+    """Create the FTS5 index over chat messages, kept in sync by triggers"""
+    global search_available
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chat_messages_fts'"
+        ).fetchone()
+        if not exists:
+            # External content table: the text is stored once, in chat_messages. chat_id and
+            # model are indexed too so filters narrow the match before anything is ranked
+            conn.execute('''
+                CREATE VIRTUAL TABLE chat_messages_fts USING fts5(
+                    user_message, bot_response, chat_id, model,
+                    content='chat_messages', content_rowid='id',
+                    tokenize='porter unicode61'
+                )
+            ''')
+            conn.execute("INSERT INTO chat_messages_fts (chat_messages_fts) VALUES ('rebuild')")
+        
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_chat_messages_fts_insert AFTER INSERT ON chat_messages
+            BEGIN
+                INSERT INTO chat_messages_fts (rowid, user_message, bot_response, chat_id, model)
+                VALUES (NEW.id, NEW.user_message, NEW.bot_response, NEW.chat_id, NEW.model);
+            END
+        ''')
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_chat_messages_fts_delete AFTER DELETE ON chat_messages
+            BEGIN
+                INSERT INTO chat_messages_fts (chat_messages_fts, rowid, user_message, bot_response, chat_id, model)
+                VALUES ('delete', OLD.id, OLD.user_message, OLD.bot_response, OLD.chat_id, OLD.model);
+            END
+        ''')
+        conn.execute('COMMIT')
+        search_available = True
+    except sqlite3.OperationalError as e:
+        conn.execute('ROLLBACK')
+        if 'fts5' not in str(e):
+            raise
+        logger.warning("SQLite was built without FTS5; /api/search is disabled")
+
+def init_stats_tables(conn):
+    """Create trigger-maintained statistics tables, seeding them once from existing rows"""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS stats_totals (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS model_usage (
+                model TEXT PRIMARY KEY,
+                usage_count INTEGER NOT NULL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS usage_rollups (
+                bucket TEXT NOT NULL,
+                model TEXT NOT NULL,
+                messages INTEGER NOT NULL,
+                latency_ms_total REAL NOT NULL,
+                latency_samples INTEGER NOT NULL,
+                PRIMARY KEY (bucket, model)
+            )
+        ''')
+        
+        # Seed from a one-off scan when the tables are new
+        if conn.execute('SELECT COUNT(*) FROM stats_totals').fetchone()[0] == 0:
+            conn.execute("INSERT INTO stats_totals (name, value) SELECT 'total_chats', COUNT(*) FROM chat_sessions")
+            conn.execute("INSERT INTO stats_totals (name, value) SELECT 'total_messages', COUNT(*) FROM chat_messages")
+            conn.execute('''
+                INSERT INTO model_usage (model, usage_count)
+                SELECT model, COUNT(*) FROM chat_messages GROUP BY model
+            ''')
+            conn.execute('''
+                INSERT INTO usage_rollups (bucket, model, messages, latency_ms_total, latency_samples)
+                SELECT strftime('%Y-%m-%d %H:00:00', timestamp), model, COUNT(*),
+                       COALESCE(SUM(latency_ms), 0), COUNT(latency_ms)
+                FROM chat_messages
+                GROUP BY 1, 2
+            ''')
+        
+        # Keep the counters in step with every write path (sync, write-behind, deletes)
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_chat_sessions_insert AFTER INSERT ON chat_sessions
+            BEGIN
+                UPDATE stats_totals SET value = value + 1 WHERE name = 'total_chats';
+            END
+        ''')
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_chat_sessions_delete AFTER DELETE ON chat_sessions
+            BEGIN
+                UPDATE stats_totals SET value = value - 1 WHERE name = 'total_chats';
+            END
+        ''')
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_chat_messages_insert AFTER INSERT ON chat_messages
+            BEGIN
+                UPDATE stats_totals SET value = value + 1 WHERE name = 'total_messages';
+                INSERT INTO model_usage (model, usage_count) VALUES (NEW.model, 1)
+                    ON CONFLICT(model) DO UPDATE SET usage_count = usage_count + 1;
+                INSERT INTO usage_rollups (bucket, model, messages, latency_ms_total, latency_samples)
+                    VALUES (strftime('%Y-%m-%d %H:00:00', NEW.timestamp), NEW.model, 1,
+                            COALESCE(NEW.latency_ms, 0), NEW.latency_ms IS NOT NULL)
+                    ON CONFLICT(bucket, model) DO UPDATE SET
+                        messages = messages + 1,
+                        latency_ms_total = latency_ms_total + excluded.latency_ms_total,
+                        latency_samples = latency_samples + excluded.latency_samples;
+            END
+        ''')
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_chat_messages_delete AFTER DELETE ON chat_messages
+            BEGIN
+                UPDATE stats_totals SET value = value - 1 WHERE name = 'total_messages';
+                UPDATE model_usage SET usage_count = usage_count - 1 WHERE model = OLD.model;
+            END
+        ''')
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+class WriteBehindQueue:
+    """Background writer that batches chat messages into SQLite transactions"""
+
+    def __init__(self, flush_interval=WRITE_BEHIND_FLUSH_MS / 1000, batch_size=WRITE_BEHIND_BATCH_SIZE, max_queue=WRITE_BEHIND_QUEUE_SIZE):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._pending = {}  # chat_id -> rows queued but not yet committed
+        self._generation = 0  # Bumped after every committed batch
+        self._thread = None
+        self._stopping = False
+        self.stats = {'enqueued': 0, 'flushed': 0, 'batches': 0, 'sync_fallbacks': 0, 'failed': 0}
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+            self._thread.start()
+            logger.info(f"Write-behind enabled (flush every {self.flush_interval * 1000:.0f}ms or {self.batch_size} rows)")
+
+    def enqueue(self, chat_id, model, user_message, bot_response, latency_ms=None):
+        """Queue a message; returns False when the caller must write synchronously"""
+        if self._stopping:
+            return False
+        timestamp = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        row = (chat_id, model, user_message, bot_response, timestamp, latency_ms)
+        with self._lock:
+            try:
+                self._queue.put_nowait(row)
+            except queue.Full:
+                self.stats['sync_fallbacks'] += 1
+                return False
+            self._pending.setdefault(chat_id, []).append(row)
+            self.stats['enqueued'] += 1
+        return True
+
+    def pending_for(self, chat_id):
+        """Snapshot of (generation, uncommitted history rows) for read-your-writes"""
+        with self._lock:
+            rows = self._pending.get(chat_id, [])
+            return self._generation, [(row[2], row[3], row[4]) for row in rows]
+
+    @property
+    def generation(self):
+        with self._lock:
+            return self._generation
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def flush(self, timeout=None):
+        """Block until every row queued so far has been committed"""
+        done = threading.Event()
+        self._queue.put(done, timeout=timeout)
+        return done.wait(timeout)
+
+    def stop(self, timeout=10):
+        """Flush outstanding rows and stop the writer (registered with atexit)"""
+        if self._thread is None or self._stopping or not self._thread.is_alive():
+            return
+        self._stopping = True
+        self.flush(timeout=timeout)
+        self._queue.put(None)
+        self._thread.join(timeout)
+        logger.info(f"Write-behind stopped after {self.stats['flushed']} rows in {self.stats['batches']} batches")
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch, waiters = [], []
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if isinstance(item, threading.Event):
+                    waiters.append(item)
+                    break  # Flush requested: commit what we have now
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)  # Re-deliver the stop signal after this batch
+                    break
+            
+            if batch:
+                self._write_batch(batch)
+            for waiter in waiters:
+                waiter.set()
+
+    def _write_batch(self, batch):
+        by_shard = {}
+        for row in batch:
+            by_shard.setdefault(shard_path(row[0]), []).append(row)
+        
+        for path, rows in by_shard.items():
+            for attempt in range(3):
+                try:
+                    conn = db_pool.get_connection(path)
+                    with DB_WRITE_SECONDS.time('write_behind'), conn:
+                        conn.executemany('''
+                            INSERT INTO chat_sessions (id, model, last_active)
+                            VALUES (?, ?, ?)
+                            ON CONFLICT(id) DO UPDATE SET model = excluded.model, last_active = excluded.last_active
+                        ''', [(row[0], row[1], row[4]) for row in rows])
+                        conn.executemany('''
+                            INSERT INTO chat_messages (chat_id, model, user_message, bot_response, timestamp, latency_ms)
+                            VALUES (?, ?, ?, ?, ?, ?)
+                        ''', rows)
+                    break
+                except sqlite3.Error as e:
+                    logger.error(f"Write-behind batch failed (attempt {attempt + 1}): {str(e)}")
+                    time.sleep(0.1 * (attempt + 1))
+            else:
+                self.stats['failed'] += len(rows)
+        
+        with self._lock:
+            for row in batch:
+                rows = self._pending.get(row[0])
+                if rows:
+                    rows.pop(0)
+                    if not rows:
+                        del self._pending[row[0]]
+            self._generation += 1
+            self.stats['flushed'] += len(batch)
+            self.stats['batches'] += 1
+
+# Optional write-behind queue; None means every save is synchronous
+write_behind = None
+if WRITE_BEHIND_ENABLED:
+    write_behind = WriteBehindQueue()
+    write_behind.start()
+    atexit.register(write_behind.stop)
+
+class ChatContextCache:
+    """LRU/TTL cache of each chat's most recent history rows"""
+
+    ROW_OVERHEAD = 64  # Rough per-row bookkeeping cost in bytes
+    STRIPES = 1024  # Write counters used to detect writes racing a cache fill
+
+    def __init__(self, window=CONTEXT_CACHE_WINDOW, max_entries=CONTEXT_CACHE_MAX_ENTRIES, max_bytes=CONTEXT_CACHE_MAX_BYTES, ttl=CONTEXT_CACHE_TTL):
+        self.window = window
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # chat_id -> [rows, size_bytes, expires_at]
+        self._write_counters = [0] * self.STRIPES
+        self._writes_in_flight = [0] * self.STRIPES
+        self._write_locks = [threading.Lock() for _ in range(64)]
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _stripe(self, chat_id):
+        return hash(chat_id) % self.STRIPES
+
+    def write_lock(self, chat_id):
+        """Lock serializing writes to chats that share chat_id's stripe"""
+        return self._write_locks[hash(chat_id) % len(self._write_locks)]
+
+    @classmethod
+    def _row_size(cls, row):
+        return sum(len(value) for value in row if isinstance(value, str)) + cls.ROW_OVERHEAD
+
+    def get(self, chat_id, limit):
+        """Cached rows for chat_id, or (None, token) to pass to fill() after a DB read"""
+        with self._lock:
+            if limit <= self.window:
+                entry = self._entries.get(chat_id)
+                if entry is not None and entry[2] > time.monotonic():
+                    self._entries.move_to_end(chat_id)
+                    self.hits += 1
+                    return entry[0][-limit:], None
+                if entry is not None:
+                    self._remove(chat_id)
+            self.misses += 1
+            return None, self._write_counters[self._stripe(chat_id)]
+
+    def fill(self, chat_id, rows, token):
+        """Store rows loaded with limit >= window unless a write raced the load"""
+        with self._lock:
+            stripe = self._stripe(chat_id)
+            if token != self._write_counters[stripe] or self._writes_in_flight[stripe]:
+                return
+            self._store(chat_id, list(rows[-self.window:]))
+
+    def begin_write(self, chat_id):
+        """Call before writing to the DB: loads that overlap the write can no longer fill the cache"""
+        with self._lock:
+            stripe = self._stripe(chat_id)
+            self._write_counters[stripe] += 1
+            self._writes_in_flight[stripe] += 1
+
+    def end_write(self, chat_id, row=None):
+        """Add the saved row to a cached chat, or drop the entry if the write failed (row None)"""
+        with self._lock:
+            stripe = self._stripe(chat_id)
+            self._write_counters[stripe] += 1
+            self._writes_in_flight[stripe] -= 1
+            entry = self._entries.get(chat_id)
+            if entry is None:
+                return
+            if row is None:
+                self._remove(chat_id)
+                return
+            self._store(chat_id, (entry[0] + [row])[-self.window:])
+
+    def invalidate(self, chat_id):
+        with self._lock:
+            self._write_counters[self._stripe(chat_id)] += 1
+            self._remove(chat_id)
+
+    def _store(self, chat_id, rows):
+        self._remove(chat_id)
+        size = sum(self._row_size(row) for row in rows)
+        if size > self.max_bytes:
+            return
+        self._entries[chat_id] = [rows, size, time.monotonic() + self.ttl]
+        self.bytes += size
+        while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, chat_id):
+        entry = self._entries.pop(chat_id, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def get_stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'evictions': self.evictions
+            }
+
+context_cache = ChatContextCache() if CONTEXT_CACHE_ENABLED else None
+
+def _query_chat_memory(chat_id, limit):
+    conn = chat_connection(chat_id)
     cursor = conn.cursor()
     
-    # Create or update chat session
-    cursor.execute('''
-        INSERT OR REPLACE INTO chat_sessions (id, model, last_active)
-        VALUES (?, ?, CURRENT_TIMESTAMP)
-    ''', (chat_id, model))
+    with DB_READ_SECONDS.time('chat_memory'):
+        cursor.execute('''
+            SELECT user_message, bot_response, timestamp 
+            FROM chat_messages 
+            WHERE chat_id = ? 
+            ORDER BY id DESC 
+            LIMIT ?
+        ''', (chat_id, limit))
+        
+        return cursor.fetchall()
+
+def get_chat_memory(chat_id, limit=CHAT_MEMORY_LIMIT):
+    """Retrieve recent chat history for context"""
+    if context_cache is None:
+        return _load_chat_memory(chat_id, limit)
     
-    # Save message
-    cursor.execute('''
-        INSERT INTO chat_messages (chat_id, model, user_message, bot_response)
-        VALUES (?, ?, ?, ?)
-    ''', (chat_id, model, user_message, bot_response))
+    cached, token = context_cache.get(chat_id, limit)
+    if cached is not None:
+        return cached
     
-    conn.commit()
-    conn.close()
+    # Load at least a full window so later, shorter reads can be served from memory
+    messages = _load_chat_memory(chat_id, max(limit, context_cache.window))
+    context_cache.fill(chat_id, messages, token)
+    return messages[-limit:]
 
-def clear_chat_memory(chat_id):
-    """Clear memory for a specific chat"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
+def _load_chat_memory(chat_id, limit):
+    if write_behind is None:
+        # Reverse to get chronological order
+        return list(reversed(_query_chat_memory(chat_id, limit)))
     
-    cursor.execute('DELETE FROM chat_messages WHERE chat_id = ?', (chat_id,))
-    cursor.execute('DELETE FROM chat_sessions WHERE id = ?', (chat_id,))
+    # Merge rows still waiting in the write-behind queue; retry if a batch
+    # committed mid-read so a row is never returned twice
+    while True:
+        generation, pending = write_behind.pending_for(chat_id)
+        messages = _query_chat_memory(chat_id, limit)
+        if write_behind.generation == generation:
+            break
     
-    conn.commit()
-    conn.close()
+    return (list(reversed(messages)) + pending)[-limit:]
 
-def call_huggingface_api(model_name, prompt, chat_history=None):
-    """Call Hugging Face API with enhanced error handling and retry logic"""
-    headers = {
-        "Authorization": f"Bearer {HF_API_KEY}",
-        "Content-Type": "application/json"
-    }
+def save_chat_message(chat_id, model, user_message, bot_response, latency_ms=None):
+    """Save chat message to database"""
+    if context_cache is None:
+        _write_chat_message(chat_id, model, user_message, bot_response, latency_ms)
+        return
     
-    # Check API key
-    if not HF_API_KEY:
-        return "Error: Hugging Face API key not set. Please set HUGGINGFACE_API_KEY environment variable."
+    # Hold the chat's stripe lock so the cached window sees writes in commit order
+    with context_cache.write_lock(chat_id):
+        context_cache.begin_write(chat_id)
+        row = None
+        try:
+            _write_chat_message(chat_id, model, user_message, bot_response, latency_ms)
+            row = (user_message, bot_response, datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'))
+        finally:
+            context_cache.end_write(chat_id, row)
+
+def _write_chat_message(chat_id, model, user_message, bot_response, latency_ms=None):
+    if write_behind is not None and write_behind.enqueue(chat_id, model, user_message, bot_response, latency_ms):
+        return
     
-    # Build context from chat history
-    context = ""
-    if chat_history:
-        for user_msg, bot_msg, _ in chat_history[-3:]:  # Last 3 exchanges for context
-            context += f"User: {user_msg}\nAssistant: {bot_msg}\n\n"
+    conn = chat_connection(chat_id)
     
-    # Format prompt based on model type
-    if "instruct" in model_name.lower() or "chat" in model_name.lower():
-        full_prompt = f"{context}User: {prompt}\nAssistant:"
-    else:
-        full_prompt = f"{context}{prompt}"
+    with DB_WRITE_SECONDS.time('sync'), conn:  # Commits, or rolls back so the pooled connection stays usable
+        # Create or update chat session (an upsert, so only new chats fire the insert trigger)
+        conn.execute('''
+            INSERT INTO chat_sessions (id, model, last_active)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(id) DO UPDATE SET model = excluded.model, last_active = excluded.last_active
+        ''', (chat_id, model))
+        
+        # Save message
+        conn.execute('''
+            INSERT INTO chat_messages (chat_id, model, user_message, bot_response, latency_ms)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (chat_id, model, user_message, bot_response, latency_ms))
+
+def clear_chat_memory(chat_id):
+    """Clear memory for a specific chat"""
+    if write_behind is not None:
+        write_behind.flush()  # Queued rows must not reappear after the delete
     
-    payload = {
-        "inputs": full_prompt,
-        "parameters": {
-            "max_new_tokens": 512,
-            "temperature": 0.7,
-            "top_p": 0.9,
-            "do_sample": True,
-            "return_full_text": False
-        }
-    }
+    conn = chat_connection(chat_id)
     
-    url = f"{HF_API_BASE}{model_name}"
+    with conn:
+        conn.execute('DELETE FROM chat_messages WHERE chat_id = ?', (chat_id,))
+        conn.execute('DELETE FROM chat_sessions WHERE id = ?', (chat_id,))
+        conn.execute('DELETE FROM chat_summaries WHERE chat_id = ?', (chat_id,))
     
-    # Retry logic for API calls
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            logger.info(f"Attempting API call to {model_name} (attempt {attempt + 1})")
-            response = requests.post(url, headers=headers, json=payload, timeout=30)
-            
-            logger.info(f"Response status: {response.status_code}")
-            
+    if context_cache is not None:
+        context_cache.invalidate(chat_id)
+
+class RetentionEngine:
+    """Deletes expired and over-cap messages in small batches, archiving them first
+
+    Archived rows are appended as JSON lines to one gzip file per day
+    (chat_messages-YYYY-MM-DD.jsonl.gz). A row is written to the archive
+    before its delete commits, so a crash in between can archive it twice
+    but never loses it.
+    """
+
+    def __init__(self, max_age_days=RETENTION_MAX_AGE_DAYS, max_messages_per_chat=RETENTION_MAX_MESSAGES_PER_CHAT,
+                 batch_size=RETENTION_BATCH_SIZE, batch_pause=RETENTION_BATCH_PAUSE_MS / 1000,
+                 archive_dir=RETENTION_ARCHIVE_DIR, interval=RETENTION_INTERVAL):
+        self.max_age_days = max_age_days
+        self.max_messages_per_chat = max_messages_per_chat
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.archive_dir = archive_dir
+        self.interval = interval
+        self._run_lock = threading.Lock()  # One pass at a time (background or on demand)
+        self._stop = threading.Event()
+        self._thread = None
+        self.last_report = None
+
+    def run_once(self):
+        """Apply retention now and return a report of what was removed and reclaimed"""
+        with self._run_lock:
+            started = time.monotonic()
+            report = {'deleted_by_age': 0, 'deleted_by_cap': 0, 'sessions_removed': 0, 'archived': 0, 'archive_files': [],
+                      'reclaimed_bytes': 0, 'free_bytes': 0, 'incremental_vacuum': True,
+                      'database_bytes_before': 0, 'database_bytes_after': 0}
+            touched = set()
+            
+            for conn in shard_connections():
+                report['database_bytes_before'] += self._database_bytes(conn)
+                self._apply(conn, report, touched)
+                reclaimed = self._reclaim(conn)
+                report['reclaimed_bytes'] += reclaimed['reclaimed_bytes']
+                report['free_bytes'] += reclaimed['free_bytes']
+                report['incremental_vacuum'] = report['incremental_vacuum'] and reclaimed['incremental_vacuum']
+                report['database_bytes_after'] += self._database_bytes(conn)
+            
+            if context_cache is not None:
+                for chat_id in touched:
+                    context_cache.invalidate(chat_id)
+            
+            report['duration_ms'] = round((time.monotonic() - started) * 1000, 1)
+            report['finished_at'] = datetime.now().isoformat()
+            self.last_report = report
+            logger.info(f"Retention removed {report['deleted_by_age'] + report['deleted_by_cap']} messages, reclaimed {report['reclaimed_bytes']} bytes")
+            return report
+
+    def _apply(self, conn, report, touched):
+        """Age and per-chat limits for one shard"""
+        if self.max_age_days > 0:
+            cutoff = (datetime.utcnow() - timedelta(days=self.max_age_days)).strftime('%Y-%m-%d %H:%M:%S')
+            report['deleted_by_age'] += self._purge(conn, 'timestamp < ?', (cutoff,), report, touched)
+            report['sessions_removed'] += self._remove_idle_sessions(conn, cutoff)
+        
+        if self.max_messages_per_chat > 0:
+            over_cap = conn.execute('''
+                SELECT chat_id FROM chat_messages
+                GROUP BY chat_id
+                HAVING COUNT(*) > ?
+            ''', (self.max_messages_per_chat,)).fetchall()
+            for (chat_id,) in over_cap:
+                # Id of the oldest message that is kept; everything before it goes
+                boundary = conn.execute('''
+                    SELECT id FROM chat_messages
+                    WHERE chat_id = ?
+                    ORDER BY id DESC
+                    LIMIT 1 OFFSET ?
+                ''', (chat_id, self.max_messages_per_chat - 1)).fetchone()
+                if boundary is not None:
+                    report['deleted_by_cap'] += self._purge(
+                        conn, 'chat_id = ? AND id < ?', (chat_id, boundary[0]), report, touched)
+
+    def _purge(self, conn, condition, params, report, touched):
+        """Archive and delete matching messages, batch_size rows per transaction"""
+        deleted = 0
+        while not self._stop.is_set():
+            rows = conn.execute(f'''
+                SELECT id, chat_id, model, user_message, bot_response, timestamp, latency_ms
+                FROM chat_messages
+                WHERE {condition}
+                ORDER BY id
+                LIMIT ?
+            ''', (*params, self.batch_size)).fetchall()
+            if not rows:
+                break
+            
+            if self.archive_dir:
+                for path in self._archive(rows):
+                    if path not in report['archive_files']:
+                        report['archive_files'].append(path)
+                report['archived'] += len(rows)
+            
+            with conn:
+                conn.executemany('DELETE FROM chat_messages WHERE id = ?', [(row[0],) for row in rows])
+            deleted += len(rows)
+            touched.update(row[1] for row in rows)
+            
+            if len(rows) < self.batch_size:
+                break
+            time.sleep(self.batch_pause)  # Let queued writers take the lock between batches
+        return deleted
+
+    def _archive(self, rows):
+        os.makedirs(self.archive_dir, exist_ok=True)
+        by_day = {}
+        for row in rows:
+            by_day.setdefault(str(row[5])[:10], []).append(row)
+        
+        paths = []
+        for day, day_rows in by_day.items():
+            path = os.path.join(self.archive_dir, f'chat_messages-{day}.jsonl.gz')
+            # Appending adds a gzip member; readers decompress the concatenation transparently
+            with gzip.open(path, 'at', encoding='utf-8') as archive:
+                for row in day_rows:
+                    archive.write(json.dumps({
+                        'id': row[0],
+                        'chat_id': row[1],
+                        'model': row[2],
+                        'user_message': row[3],
+                        'bot_response': row[4],
+                        'timestamp': row[5],
+                        'latency_ms': row[6]
+                    }) + '\n')
+            paths.append(path)
+        return paths
+
+    def _remove_idle_sessions(self, conn, cutoff):
+        """Drop sessions (and summaries) idle since cutoff that have no messages left"""
+        with conn:
+            conn.execute('''
+                DELETE FROM chat_summaries
+                WHERE chat_id IN (
+                    SELECT id FROM chat_sessions s
+                    WHERE s.last_active < ?
+                    AND NOT EXISTS (SELECT 1 FROM chat_messages m WHERE m.chat_id = s.id)
+                )
+            ''', (cutoff,))
+            cursor = conn.execute('''
+                DELETE FROM chat_sessions
+                WHERE last_active < ?
+                AND NOT EXISTS (SELECT 1 FROM chat_messages m WHERE m.chat_id = chat_sessions.id)
+            ''', (cutoff,))
+        return cursor.rowcount
+
+    def _reclaim(self, conn):
+        """Return free pages to the filesystem a step at a time (needs auto_vacuum=INCREMENTAL)"""
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        free_before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            return {'reclaimed_bytes': 0, 'free_bytes': free_before * page_size, 'incremental_vacuum': False}
+        
+        while not self._stop.is_set():
+            free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            if free == 0:
+                break
+            conn.execute(f'PRAGMA incremental_vacuum({RETENTION_VACUUM_PAGES})').fetchall()
+            if conn.execute('PRAGMA freelist_count').fetchone()[0] >= free:
+                break
+            time.sleep(self.batch_pause)
+        
+        free_after = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        return {
+            'reclaimed_bytes': (free_before - free_after) * page_size,
+            'free_bytes': free_after * page_size,
+            'incremental_vacuum': True
+        }
+
+    @staticmethod
+    def _database_bytes(conn):
+        return conn.execute('PRAGMA page_count').fetchone()[0] * conn.execute('PRAGMA page_size').fetchone()[0]
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='retention', daemon=True)
+            self._thread.start()
+            logger.info(f"Retention started (max age {self.max_age_days}d, max {self.max_messages_per_chat} messages per chat, every {self.interval}s)")
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except (sqlite3.Error, OSError) as e:  # Archive writes can fail too; try again next interval
+                logger.error(f"Retention pass failed: {str(e)}")
+            self._stop.wait(self.interval)
+
+retention_engine = RetentionEngine()
+
+# Default generation parameters sent with every chat request
+GENERATION_PARAMETERS = {
+    "max_new_tokens": 512,
+    "temperature": 0.7,
+    "top_p": 0.9,
+    "do_sample": True,
+    "return_full_text": False
+}
+
+TOKEN_PATTERN = re.compile(r"\w{1,4}|[^\w\s]")
+
+def estimate_tokens(text):
+    """Fast local token estimate: word pieces of up to 4 characters plus punctuation"""
+    return len(TOKEN_PATTERN.findall(text))
+
+def truncate_to_tokens(text, max_tokens):
+    """Keep the end of text so that it fits in max_tokens (estimated)"""
+    if max_tokens <= 0:
+        return ''
+    while estimate_tokens(text) > max_tokens:
+        overshoot = estimate_tokens(text) - max_tokens
+        text = text[max(overshoot * 2, 1):]
+    return text
+
+def get_prompt_budget(model_name):
+    return MODELS_CONFIG.get(model_name, {}).get('max_input_tokens', DEFAULT_MAX_INPUT_TOKENS)
+
+def build_full_prompt(model_name, prompt, chat_history=None, summary=None):
+    """Build the model prompt from the user message, recent history and an optional summary"""
+    budget = get_prompt_budget(model_name)
+    
+    # Format prompt based on model type; the new message always survives (truncated if huge)
+    if "instruct" in model_name.lower() or "chat" in model_name.lower():
+        tail = f"User: {prompt}\nAssistant:"
+    else:
+        tail = prompt
+    tail = truncate_to_tokens(tail, budget)
+    remaining = budget - estimate_tokens(tail)
+    
+    # Add the newest turns that still fit, then restore chronological order
+    turns = []
+    for user_msg, bot_msg, _ in reversed((chat_history or [])[-CONTEXT_MAX_TURNS:]):
+        turn = f"User: {user_msg}\nAssistant: {bot_msg}\n\n"
+        cost = estimate_tokens(turn)
+        if cost > remaining:
+            break
+        turns.append(turn)
+        remaining -= cost
+    turns.reverse()
+    
+    if summary:
+        summary_text = f"Earlier in this conversation: {summary}\n\n"
+        if estimate_tokens(summary_text) <= remaining:
+            turns.insert(0, summary_text)
+    
+    return ''.join(turns) + tail
+
+SUMMARY_TURN_SPLIT = re.compile(r' (?=User asked: )')
+
+def _first_sentence(text, max_chars=120):
+    sentence = re.split(r'(?<=[.!?])\s|\n', text.strip(), maxsplit=1)[0]
+    return sentence[:max_chars]
+
+def get_chat_summary(chat_id):
+    """Stored rolling summary for chat_id, or None"""
+    if not CONTEXT_SUMMARIES_ENABLED:
+        return None
+    row = chat_connection(chat_id).execute(
+        'SELECT summary FROM chat_summaries WHERE chat_id = ?', (chat_id,)
+    ).fetchone()
+    return row[0] if row else None
+
+def update_chat_summary(chat_id, window=min(CHAT_MEMORY_LIMIT, CONTEXT_MAX_TURNS)):
+    """Fold turns that dropped out of the prompt's history window into the chat's summary"""
+    if not CONTEXT_SUMMARIES_ENABLED:
+        return
+    conn = chat_connection(chat_id)
+    row = conn.execute(
+        'SELECT summary, summarized_through FROM chat_summaries WHERE chat_id = ?', (chat_id,)
+    ).fetchone()
+    summary, summarized_through = row if row else ('', 0)
+    
+    # Unsummarized messages older than the newest `window` ones
+    older = conn.execute('''
+        SELECT id, user_message, bot_response FROM chat_messages
+        WHERE chat_id = ? AND id > ?
+        ORDER BY id DESC
+        LIMIT -1 OFFSET ?
+    ''', (chat_id, summarized_through, window)).fetchall()
+    if not older:
+        return
+    
+    # One line per summarized turn, so trimming below drops the oldest turn rather than the whole summary
+    lines = SUMMARY_TURN_SPLIT.split(summary) if summary else []
+    for _, user_msg, bot_msg in reversed(older):
+        lines.append(f"User asked: {_first_sentence(user_msg)} Assistant: {_first_sentence(bot_msg)}")
+    
+    # Keep the most recent part of the summary within its token budget
+    while len(lines) > 1 and estimate_tokens(' '.join(lines)) > CONTEXT_SUMMARY_TOKENS:
+        lines.pop(0)
+    new_summary = truncate_to_tokens(' '.join(lines), CONTEXT_SUMMARY_TOKENS)
+    
+    with conn:
+        conn.execute('''
+            INSERT OR REPLACE INTO chat_summaries (chat_id, summary, summarized_through, updated_at)
+            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+        ''', (chat_id, new_summary, older[0][0]))
+
+def payload_key(model_name, payload):
+    """Stable hash of (model, full prompt, generation parameters)"""
+    material = json.dumps([model_name, payload.get('inputs'), payload.get('parameters', {})], sort_keys=True)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+class SingleFlight:
+    """Shares one in-flight call among concurrent callers with the same key"""
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+            self.waiters = 0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.stats = {'calls': 0, 'executed': 0, 'coalesced': 0}
+
+    def do(self, key, fn):
+        """Return fn()'s result, running it only once for concurrent callers of key"""
+        with self._lock:
+            self.stats['calls'] += 1
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.stats['coalesced'] += 1
+                leader = False
+            else:
+                call = self._calls[key] = self._Call()
+                self.stats['executed'] += 1
+                leader = True
+        
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, in_flight=len(self._calls))
+
+single_flight = SingleFlight() if SINGLE_FLIGHT_ENABLED else None
+
+UPSTREAM_BATCH_SIZE = metrics.histogram('upstream_batch_size', 'Prompts per batched Inference API request', ('model',),
+                                        buckets=(1, 2, 4, 8, 16, 32))
+
+class BatchItemResponse:
+    """One caller's share of a batched response, with the parts of requests.Response the callers use"""
+
+    def __init__(self, status_code, result, text=None):
+        self.status_code = status_code
+        self._result = result
+        self.text = text if text is not None else json.dumps(result)
+
+    def json(self):
+        return self._result
+
+class UpstreamBatcher:
+    """Groups concurrent prompts for the same model and parameters into one Inference API request
+
+    The first caller for a (url, parameters) key leads. It waits up to
+    window seconds (or until max_size prompts have joined), then sends
+    all inputs as a list and hands each caller its own result. Errors stay
+    per item: 503/429 answers apply to the whole batch and every caller
+    retries as usual. Any other failure, or an item without a usable
+    result, sends that caller's prompt again on its own.
+    
+    Outcomes go to the monitor, breaker and latency histogram once per
+    upstream request made here, so callers must not record them again.
+    """
+
+    class _Batch:
+        def __init__(self):
+            self.inputs = []
+            self.responses = []  # Filled by the leader: BatchItemResponse, or None for "send it alone"
+            self.error = None
+            self.full = threading.Event()
+            self.done = threading.Event()
+
+    def __init__(self, window=UPSTREAM_BATCH_WINDOW_MS / 1000, max_size=UPSTREAM_BATCH_MAX_SIZE):
+        self.window = window
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._open = {}
+        self.stats = {'requests': 0, 'batches': 0, 'batched_items': 0, 'item_fallbacks': 0, 'batch_fallbacks': 0}
+
+    def post(self, model_name, url, payload, timeout=30):
+        """Response for this caller's payload, possibly sent as part of a batch"""
+        key = (url, json.dumps(payload.get('parameters', {}), sort_keys=True))
+        with self._lock:
+            self.stats['requests'] += 1
+            batch = self._open.get(key)
+            leader = batch is None
+            if leader:
+                batch = self._open[key] = self._Batch()
+            index = len(batch.inputs)
+            batch.inputs.append(payload['inputs'])
+            if len(batch.inputs) >= self.max_size:
+                del self._open[key]
+                batch.full.set()
+        
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._open.get(key) is batch:
+                    del self._open[key]
+            try:
+                self._send(model_name, url, payload, batch, timeout)
+            except Exception as e:
+                batch.error = e
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+        
+        if batch.error is not None:
+            raise batch.error
+        response = batch.responses[index]
+        if response is None:
+            with self._lock:
+                self.stats['item_fallbacks'] += 1
+            with upstream_admission(model_name):
+                response = self._post(model_name, url, payload, timeout)
+        return response
+
+    @staticmethod
+    def _post(model_name, url, payload, timeout):
+        """One real upstream request, with its outcome recorded exactly once"""
+        start_time = time.time()
+        try:
+            response = inference_client.post(url, json=payload, timeout=timeout)
+        except requests.exceptions.RequestException:
+            record_upstream_outcome(model_name, None, time.time() - start_time)
+            raise
+        record_upstream_outcome(model_name, response.status_code, time.time() - start_time)
+        return response
+
+    def _send(self, model_name, url, payload, batch, timeout):
+        size = len(batch.inputs)
+        UPSTREAM_BATCH_SIZE.observe(size, model_name)
+        with self._lock:
+            self.stats['batches'] += 1
+            self.stats['batched_items'] += size
+        
+        with upstream_admission(model_name):  # One admission slot per upstream request, not per prompt
+            if size == 1:
+                batch.responses = [self._post(model_name, url, payload, timeout)]
+                return
+            response = self._post(model_name, url, dict(payload, inputs=batch.inputs), timeout)
+        
+        if response.status_code in (503, 429):
+            # Model-wide conditions: every caller sees them and applies its own retry policy
+            batch.responses = [response] * size
+            return
+        
+        results = None
+        if response.status_code == 200:
+            try:
+                results = response.json()
+            except ValueError:
+                results = None
+        if not isinstance(results, list) or len(results) != size:
+            logger.info(f"Batched request for {model_name} failed ({response.status_code}), sending items individually")
+            with self._lock:
+                self.stats['batch_fallbacks'] += 1
+            batch.responses = [None] * size
+            return
+        
+        responses = []
+        for item in results:
+            # Pipelines answer a list input with one list (or dict) per prompt
+            item = item if isinstance(item, list) else [item]
+            usable = bool(item) and isinstance(item[0], dict) and 'error' not in item[0]
+            responses.append(BatchItemResponse(200, item) if usable else None)
+        batch.responses = responses
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats['avg_batch_size'] = round(stats['batched_items'] / stats['batches'], 2) if stats['batches'] else 0.0
+        return stats
+
+upstream_batcher = UpstreamBatcher() if UPSTREAM_BATCH_ENABLED else None
+
+class ResponseCache:
+    """Two-tier (memory LRU + SQLite) cache of model responses for repeated prompts"""
+
+    PRUNE_EVERY = 100  # Writes between persistent-tier size checks
+
+    def __init__(self, ttl=RESPONSE_CACHE_TTL, max_entries=RESPONSE_CACHE_MAX_ENTRIES, db_max_rows=RESPONSE_CACHE_DB_MAX_ROWS, allow_sampled=RESPONSE_CACHE_ALLOW_SAMPLED):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.db_max_rows = db_max_rows
+        self.allow_sampled = allow_sampled
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (response, expires_at)
+        self._writes = 0
+        self.stats = {'memory_hits': 0, 'db_hits': 0, 'misses': 0, 'bypassed': 0, 'stores': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def make_key(self, model_name, payload):
+        """Cache key for a request, or None when sampling makes it non-deterministic"""
+        parameters = payload.get('parameters', {})
+        if parameters.get('do_sample') and not self.allow_sampled:
+            self._count('bypassed')
+            return None
+        return payload_key(model_name, payload)
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries.move_to_end(key)
+                    self.stats['memory_hits'] += 1
+                    return entry[0]
+                del self._entries[key]
+        
+        try:
+            conn = db_pool.get_connection()
+            row = conn.execute(
+                'SELECT response, expires_at FROM response_cache WHERE key = ? AND expires_at > ?',
+                (key, now)
+            ).fetchone()
+            if row is not None:
+                with conn:
+                    conn.execute('UPDATE response_cache SET last_used = ? WHERE key = ?', (now, key))
+        except sqlite3.Error as e:
+            logger.error(f"Response cache read error: {str(e)}")
+            row = None
+        
+        if row is None:
+            self._count('misses')
+            return None
+        
+        self._remember(key, row[0], row[1])
+        self._count('db_hits')
+        return row[0]
+
+    def put(self, key, model_name, response):
+        now = time.time()
+        expires_at = now + self.ttl
+        self._remember(key, response, expires_at)
+        try:
+            conn = db_pool.get_connection()
+            with conn:
+                conn.execute('''
+                    INSERT OR REPLACE INTO response_cache (key, model, response, expires_at, last_used)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (key, model_name, response, expires_at, now))
+            with self._lock:
+                self.stats['stores'] += 1
+                self._writes += 1
+                prune = self._writes % self.PRUNE_EVERY == 0
+            if prune:
+                self._prune(conn, now)
+        except sqlite3.Error as e:
+            logger.error(f"Response cache write error: {str(e)}")
+
+    def _remember(self, key, response, expires_at):
+        with self._lock:
+            self._entries[key] = (response, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _prune(self, conn, now):
+        """Drop expired rows, then least recently used rows above db_max_rows"""
+        with conn:
+            conn.execute('DELETE FROM response_cache WHERE expires_at <= ?', (now,))
+            conn.execute('''
+                DELETE FROM response_cache WHERE key IN (
+                    SELECT key FROM response_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )
+            ''', (self.db_max_rows,))
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, memory_entries=len(self._entries), allow_sampled=self.allow_sampled)
+
+response_cache = ResponseCache() if RESPONSE_CACHE_ENABLED else None
+
+class LocalInferenceError(Exception):
+    """The local engine could not serve a prompt; callers fall back to the remote API"""
+
+class FakeLocalModel:
+    """Deterministic stand-in for a local model, for testing and benchmarking the batcher offline
+
+    A batch costs batch_ms plus item_ms per prompt, which mimics how a CPU
+    forward pass amortises over the batch. The reply depends only on the
+    model name and prompt.
+    """
+
+    WORDS = ('sure', 'here', 'is', 'a', 'simple', 'answer', 'that', 'should', 'help', 'with', 'your', 'question')
+
+    def __init__(self, batch_ms=LOCAL_FAKE_BATCH_MS, item_ms=LOCAL_FAKE_ITEM_MS, max_new_tokens=LOCAL_MAX_NEW_TOKENS):
+        self.batch_ms = batch_ms
+        self.item_ms = item_ms
+        self.max_new_tokens = max_new_tokens
+
+    def generate_batch(self, model_name, prompts):
+        time.sleep((self.batch_ms + self.item_ms * len(prompts)) / 1000)
+        replies = []
+        for prompt in prompts:
+            digest = hashlib.sha256(f'{model_name}\0{prompt}'.encode('utf-8')).digest()
+            count = 4 + digest[0] % min(12, max(self.max_new_tokens - 3, 1))
+            replies.append(' '.join(self.WORDS[byte % len(self.WORDS)] for byte in digest[1:count + 1]).capitalize() + '.')
+        return replies
+
+class TransformersBackend:
+    """Causal LMs from the transformers library, loaded once per process and shared by all threads"""
+
+    def __init__(self, max_new_tokens=LOCAL_MAX_NEW_TOKENS):
+        import torch
+        import transformers
+        self.torch = torch
+        self.transformers = transformers
+        self.max_new_tokens = max_new_tokens
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def load(self, model_name):
+        with self._lock:
+            if model_name not in self._models:
+                tokenizer = self.transformers.AutoTokenizer.from_pretrained(model_name)
+                tokenizer.padding_side = 'left'  # Generation continues from the right edge
+                tokenizer.truncation_side = 'left'  # Like build_prompt, drop the oldest history, never the new message
+                if tokenizer.pad_token is None:
+                    tokenizer.pad_token = tokenizer.eos_token
+                model = self.transformers.AutoModelForCausalLM.from_pretrained(model_name)
+                model.eval()
+                self._models[model_name] = (tokenizer, model)
+                logger.info(f"Loaded local model {model_name}")
+            return self._models[model_name]
+
+    def generate_batch(self, model_name, prompts):
+        tokenizer, model = self.load(model_name)
+        encoded = tokenizer(prompts, return_tensors='pt', padding=True, truncation=True,
+                            max_length=get_prompt_budget(model_name))
+        with self.torch.no_grad():
+            output = model.generate(
+                **encoded,
+                max_new_tokens=self.max_new_tokens,
+                do_sample=GENERATION_PARAMETERS['do_sample'],
+                temperature=GENERATION_PARAMETERS['temperature'],
+                top_p=GENERATION_PARAMETERS['top_p'],
+                pad_token_id=tokenizer.pad_token_id
+            )
+        prompt_length = encoded['input_ids'].shape[1]
+        return [tokenizer.decode(row[prompt_length:], skip_special_tokens=True).strip() for row in output]
+
+LOCAL_BATCH_SIZE = metrics.histogram('local_batch_size', 'Prompts per local forward pass', ('model',),
+                                     buckets=(1, 2, 4, 8, 16, 32, 64))
+LOCAL_BATCH_SECONDS = metrics.histogram('local_batch_seconds', 'Local forward pass time', ('model',))
+
+class LocalInferenceEngine:
+    """Per-model micro-batching in front of a local backend
+
+    Each model has a queue and a scheduler thread. The thread takes the
+    first waiting prompt, keeps collecting until max_batch prompts are in
+    hand or max_wait has passed, and runs them as one batch.
+    """
+
+    def __init__(self, backend, models, max_batch=LOCAL_BATCH_MAX_SIZE, max_wait=LOCAL_BATCH_MAX_WAIT_MS / 1000,
+                 queue_size=LOCAL_QUEUE_SIZE, timeout=LOCAL_TIMEOUT):
+        self.backend = backend
+        self.models = set(models)
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self._queues = {model: queue.Queue(maxsize=queue_size) for model in self.models}
+        self._threads = []
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'batches': 0, 'batched_items': 0, 'failures': 0, 'rejected_queue_full': 0, 'timeouts': 0}
+
+    def serves(self, model_name):
+        return model_name in self.models
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for model_name, model_queue in self._queues.items():
+                thread = threading.Thread(target=self._run, args=(model_name, model_queue),
+                                          name=f'local-batcher-{model_name}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        logger.info(f"Local inference started for {', '.join(sorted(self.models))} (batch {self.max_batch}, wait {self.max_wait * 1000:.0f}ms)")
+
+    def stop(self):
+        for model_queue in self._queues.values():
+            try:
+                model_queue.put_nowait(None)
+            except queue.Full:
+                pass
+
+    def submit(self, model_name, prompt):
+        """Queue a prompt; returns a Future for the generated text"""
+        if not self._threads:
+            self.start()  # Lazily, so pre-forked workers each get their own scheduler threads
+        future = Future()
+        try:
+            self._queues[model_name].put_nowait((prompt, future))
+        except queue.Full:
+            with self._lock:
+                self.stats['rejected_queue_full'] += 1
+            raise LocalInferenceError(f'Local queue for {model_name} is full')
+        with self._lock:
+            self.stats['requests'] += 1
+        return future
+
+    def generate(self, model_name, prompt):
+        """Generated text, or raise LocalInferenceError so the caller can go remote"""
+        future = self.submit(model_name, prompt)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            with self._lock:
+                self.stats['timeouts'] += 1
+            raise LocalInferenceError(f'Local generation for {model_name} timed out')
+
+    def _run(self, model_name, model_queue):
+        while True:
+            item = model_queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = model_queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    model_queue.put(None)  # Finish this batch, then stop
+                    break
+                batch.append(item)
+            
+            # Prompts whose caller already gave up are not worth computing
+            batch = [(prompt, future) for prompt, future in batch if future.set_running_or_notify_cancel()]
+            if batch:
+                self._run_batch(model_name, batch)
+
+    def _run_batch(self, model_name, batch):
+        start = time.perf_counter()
+        try:
+            replies = self.backend.generate_batch(model_name, [prompt for prompt, _ in batch])
+        except Exception as e:
+            logger.error(f"Local batch for {model_name} failed: {str(e)}")
+            with self._lock:
+                self.stats['failures'] += 1
+            for _, future in batch:
+                future.set_exception(LocalInferenceError(str(e)))
+            return
+        
+        LOCAL_BATCH_SIZE.observe(len(batch), model_name)
+        LOCAL_BATCH_SECONDS.observe(time.perf_counter() - start, model_name)
+        with self._lock:
+            self.stats['batches'] += 1
+            self.stats['batched_items'] += len(batch)
+        for (_, future), reply in zip(batch, replies):
+            future.set_result(reply)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats['avg_batch_size'] = round(stats['batched_items'] / stats['batches'], 2) if stats['batches'] else 0.0
+        stats['queue_depth'] = {model: q.qsize() for model, q in self._queues.items()}
+        stats['models'] = sorted(self.models)
+        return stats
+
+def create_local_engine():
+    """The configured local engine, or None when disabled or the backend is unavailable"""
+    if not LOCAL_INFERENCE_ENABLED:
+        return None
+    if LOCAL_BACKEND == 'fake':
+        backend = FakeLocalModel()
+    elif LOCAL_BACKEND == 'transformers':
+        try:
+            backend = TransformersBackend()
+        except ImportError as e:
+            logger.warning(f"Local inference disabled, transformers backend unavailable: {str(e)}")
+            return None
+    else:
+        logger.warning(f"Local inference disabled, unknown LOCAL_BACKEND '{LOCAL_BACKEND}'")
+        return None
+    return LocalInferenceEngine(backend, [m for m in LOCAL_MODELS if m in MODELS_CONFIG])
+
+local_engine = create_local_engine()
+
+def local_reply(model_name, full_prompt):
+    """(reply, ok) from the local engine, or None to use the remote API"""
+    if local_engine is None or not local_engine.serves(model_name):
+        return None
+    try:
+        text = local_engine.generate(model_name, full_prompt)
+    except LocalInferenceError as e:
+        logger.info(f"Local inference for {model_name} unavailable, using remote API: {str(e)}")
+        return None
+    return parse_generated_text([{'generated_text': text}]), bool(text.strip())
+
+class ModelHealthMonitor:
+    """Tracks per-model availability and latency from probes and live traffic"""
+
+    STATUS_BY_CODE = {200: 'available', 503: 'loading', 404: 'not_found', 429: 'rate_limited', 401: 'unauthorized'}
+
+    def __init__(self, probe_interval=MODEL_PROBE_INTERVAL, warm_interval=MODEL_WARM_INTERVAL, warm_top_n=MODEL_WARM_TOP_N, status_ttl=MODEL_STATUS_TTL):
+        self.probe_interval = probe_interval
+        self.warm_interval = warm_interval
+        self.warm_top_n = warm_top_n
+        self.status_ttl = status_ttl
+        self._lock = threading.Lock()
+        self._status = {}  # model -> latest observation
+        self._stop = threading.Event()
+        self._thread = None
+
+    def observe(self, model_name, status_code, latency=None, source='traffic'):
+        """Record the outcome of any upstream call (status_code None means no response)"""
+        status = self.STATUS_BY_CODE.get(status_code, 'error') if status_code is not None else 'unreachable'
+        with self._lock:
+            entry = self._status.setdefault(model_name, {'probes': 0, 'failures': 0})
+            entry.update({
+                'status': status,
+                'status_code': status_code,
+                'observed_at': time.time(),
+                'source': source
+            })
+            if latency is not None and status == 'available' and source in ('probe', 'warmup'):
+                # One-token probes say nothing about full generations; keep them out of routing
+                entry['probe_latency_ms'] = round(latency * 1000, 1)
+            elif latency is not None and status == 'available':
+                entry['latency_ms'] = round(latency * 1000, 1)
+                previous = entry.get('ewma_latency_ms')
+                entry['ewma_latency_ms'] = entry['latency_ms'] if previous is None else round(
+                    ROUTING_EWMA_ALPHA * entry['latency_ms'] + (1 - ROUTING_EWMA_ALPHA) * previous, 1)
+            success = 1.0 if status == 'available' else 0.0
+            previous = entry.get('ewma_success')
+            entry['ewma_success'] = success if previous is None else round(
+                ROUTING_EWMA_ALPHA * success + (1 - ROUTING_EWMA_ALPHA) * previous, 3)
+            if source == 'probe':
+                entry['probes'] += 1
+            if status != 'available':
+                entry['failures'] += 1
+
+    def get_status(self, model_name):
+        with self._lock:
+            entry = self._status.get(model_name)
+            if entry is None:
+                return {'status': 'unknown'}
+            entry = dict(entry)
+        age = time.time() - entry['observed_at']
+        if age > self.status_ttl:
+            entry['status'] = 'unknown'
+        entry['age_seconds'] = round(age, 1)
+        entry['last_checked'] = datetime.fromtimestamp(entry.pop('observed_at')).isoformat()
+        return entry
+
+    def known_down(self, model_name, window=MODEL_FAIL_FAST_WINDOW):
+        """Recent 'loading'/'not_found' status for fail-fast decisions, else None"""
+        with self._lock:
+            entry = self._status.get(model_name)
+            if entry is None or time.time() - entry['observed_at'] > window:
+                return None
+            return entry['status'] if entry['status'] in ('loading', 'not_found') else None
+
+    def expected_cost(self, model_name):
+        """EWMA latency divided by EWMA success rate; lower is better"""
+        with self._lock:
+            entry = self._status.get(model_name) or {}
+            latency = entry.get('ewma_latency_ms', ROUTING_DEFAULT_LATENCY * 1000) / 1000
+            success = entry.get('ewma_success', 1.0)
+        if self.known_down(model_name) or (circuit_breakers is not None and circuit_breakers.is_open(model_name)):
+            return float('inf')
+        return latency / max(success, 0.05)
+
+    def rank(self, model_names):
+        """Models ordered best first by expected cost"""
+        return sorted(model_names, key=self.expected_cost)
+
+    def probe(self, model_name, source='probe'):
+        """Send a one-token generation request and record the outcome"""
+        payload = {
+            "inputs": "Hello",
+            "parameters": {"max_new_tokens": 1, "return_full_text": False},
+            "options": {"wait_for_model": False, "use_cache": False}
+        }
+        fanout_bucket.acquire()
+        start = time.time()
+        try:
+            response = inference_client.post(f"{HF_API_BASE}{model_name}", json=payload, timeout=30)
+            self.observe(model_name, response.status_code, time.time() - start, source=source)
+        except requests.exceptions.RequestException as e:
+            logger.info(f"Probe of {model_name} failed: {str(e)}")
+            self.observe(model_name, None, source=source)
+
+    def start(self):
+        if self._thread is None and HF_API_KEY:
+            self._thread = threading.Thread(target=self._run, name='model-prober', daemon=True)
+            self._thread.start()
+            logger.info(f"Model prober started (probe every {self.probe_interval}s, warm top {self.warm_top_n} every {self.warm_interval}s)")
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        next_probe = 0
+        while not self._stop.is_set():
+            now = time.monotonic()
+            if now >= next_probe:
+                for model_name in MODELS_CONFIG:
+                    if self._stop.is_set():
+                        return
+                    self.probe(model_name)
+                next_probe = time.monotonic() + self.probe_interval
+            else:
+                self._warm_popular_models()
+            self._stop.wait(min(self.warm_interval, max(next_probe - time.monotonic(), 0)))
+
+    def _warm_popular_models(self):
+        try:
+            popular = [model for model, _ in get_popular_models(self.warm_top_n) if model in MODELS_CONFIG]
+        except sqlite3.Error as e:
+            logger.error(f"Warm-up could not read usage counts: {str(e)}")
+            return
+        for model_name in popular:
+            self.probe(model_name, source='warmup')
+
+model_monitor = ModelHealthMonitor()
+
+def extract_generated_text(result):
+    """Generated text from an Inference API response, or an empty string"""
+    if isinstance(result, list) and len(result) > 0 and isinstance(result[0], dict):
+        return (result[0].get('generated_text') or '').strip()
+    return ''
+
+def parse_generated_text(result):
+    """Extract the reply from a successful Inference API response"""
+    if isinstance(result, list) and len(result) > 0:
+        generated_text = extract_generated_text(result)
+        if generated_text:
+            return generated_text
+        else:
+            return "I apologize, but I couldn't generate a proper response. Please try rephrasing your question."
+    else:
+        return "I received an unexpected response format. Please try again."
+
+def get_history_page(chat_id, limit=HISTORY_PAGE_SIZE, before=None, after=None):
+    """One page of history in id order; returns (rows oldest first, has_more)
+
+    Without a cursor the newest page is returned. `before` pages towards older
+    messages and `after` towards newer ones.
+    """
+    conn = chat_connection(chat_id)
+    if after is not None:
+        rows = conn.execute('''
+            SELECT id, user_message, bot_response, timestamp, model
+            FROM chat_messages
+            WHERE chat_id = ? AND id > ?
+            ORDER BY id ASC
+            LIMIT ?
+        ''', (chat_id, after, limit + 1)).fetchall()
+        return rows[:limit], len(rows) > limit
+    
+    rows = conn.execute('''
+        SELECT id, user_message, bot_response, timestamp, model
+        FROM chat_messages
+        WHERE chat_id = ? AND id < ?
+        ORDER BY id DESC
+        LIMIT ?
+    ''', (chat_id, before if before is not None else 2 ** 63 - 1, limit + 1)).fetchall()
+    return list(reversed(rows[:limit])), len(rows) > limit
+
+def fts_phrase(text):
+    return '"' + text.replace('"', '""') + '"'
+
+def build_search_query(text, chat_id=None, model=None):
+    """Turn free text into an FTS5 query over the message columns
+
+    Every term must match and a trailing * keeps prefix search. Filters
+    become column phrases so FTS5 intersects them before ranking; callers
+    still compare the real columns, since a phrase can match a longer id.
+    """
+    terms = re.findall(r'\w+\*?', text)
+    if not terms:
+        return ''
+    query = '{user_message bot_response} : (' + ' '.join(
+        fts_phrase(term.rstrip('*')) + ('*' if term.endswith('*') else '') for term in terms) + ')'
+    if chat_id:
+        query += ' AND chat_id : ' + fts_phrase(chat_id)
+    if model:
+        query += ' AND model : ' + fts_phrase(model)
+    return query
+
+def search_messages(text, chat_id=None, model=None, limit=SEARCH_PAGE_SIZE, offset=0, order='rank'):
+    """Messages matching text, best bm25 score first (or newest first); returns (rows, has_more)
+
+    Ranking scores every match, so very common terms cost more than
+    order='recent', which stops after the first page.
+    """
+    query = build_search_query(text, chat_id, model)
+    if not query:
+        return [], False
+    
+    filters = ''
+    params = [query]
+    if chat_id:
+        filters += ' AND m.chat_id = ?'
+        params.append(chat_id)
+    if model:
+        filters += ' AND m.model = ?'
+        params.append(model)
+    order_by = 'chat_messages_fts.rowid DESC' if order == 'recent' else 'score'
+    sql = f'''
+        SELECT m.id, m.chat_id, m.model, m.timestamp,
+               snippet(chat_messages_fts, 0, '[', ']', '...', 12),
+               snippet(chat_messages_fts, 1, '[', ']', '...', 12),
+               bm25(chat_messages_fts, 1.0, 1.0, 0.0, 0.0) AS score
+        FROM chat_messages_fts
+        JOIN chat_messages m ON m.id = chat_messages_fts.rowid
+        WHERE chat_messages_fts MATCH ?{filters}
+        ORDER BY {order_by}
+        LIMIT ? OFFSET ?
+    '''
+    
+    connections = [chat_connection(chat_id)] if chat_id else shard_connections()
+    if len(connections) == 1:
+        rows = connections[0].execute(sql, (*params, limit + 1, offset)).fetchall()
+        return rows[:limit], len(rows) > limit
+    
+    # Each shard contributes its own best offset + limit + 1 rows; merge and cut the page
+    rows = []
+    for conn in connections:
+        rows.extend(conn.execute(sql, (*params, offset + limit + 1, 0)).fetchall())
+    if order == 'recent':
+        rows.sort(key=lambda row: (row[3], row[0]), reverse=True)
+    else:
+        rows.sort(key=lambda row: row[6])
+    rows = rows[offset:offset + limit + 1]
+    return rows[:limit], len(rows) > limit
+
+def iter_chat_transcript(chat_id, batch_size=HISTORY_EXPORT_BATCH):
+    """Yield every message of a chat oldest first, one keyset batch at a time"""
+    last_id = 0
+    while True:
+        rows, has_more = get_history_page(chat_id, limit=batch_size, after=last_id)
+        yield from rows
+        if not has_more or not rows:
+            return
+        last_id = rows[-1][0]
+
+def get_popular_models(limit=5):
+    """Most used models by message count, as (model, usage_count) rows"""
+    counts = {}
+    for conn in shard_connections():
+        for model, usage_count in conn.execute('SELECT model, usage_count FROM model_usage WHERE usage_count > 0'):
+            counts[model] = counts.get(model, 0) + usage_count
+    return sorted(counts.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+def get_usage_rollups(hours=24):
+    """Hourly message counts and average upstream latency per model"""
+    cutoff = (datetime.utcnow() - timedelta(hours=hours - 1)).strftime('%Y-%m-%d %H:00:00')
+    merged = {}
+    for conn in shard_connections():
+        for bucket, model, messages, latency_total, samples in conn.execute('''
+            SELECT bucket, model, messages, latency_ms_total, latency_samples
+            FROM usage_rollups
+            WHERE bucket >= ?
+        ''', (cutoff,)):
+            totals = merged.setdefault((bucket, model), [0, 0.0, 0])
+            totals[0] += messages
+            totals[1] += latency_total
+            totals[2] += samples
+    return [
+        {
+            'bucket': bucket,
+            'model': model,
+            'messages': messages,
+            'avg_latency_ms': round(latency_total / samples, 1) if samples else None
+        } for (bucket, model), (messages, latency_total, samples) in sorted(merged.items())
+    ]
+
+def fail_fast_response(model_name):
+    """Immediate reply for models the monitor recently saw loading or missing"""
+    if not MODEL_FAIL_FAST:
+        return None
+    status = model_monitor.known_down(model_name)
+    if status == 'loading':
+        return "The AI model is currently loading. Please try again in a few moments."
+    if status == 'not_found':
+        return f"Error: Model '{model_name}' not found. This model may not exist or may not be available via the Inference API."
+    return None
+
+def call_huggingface_api(model_name, prompt, chat_history=None, summary=None):
+    """Call Hugging Face API with enhanced error handling and retry logic"""
+    return generate_reply(model_name, prompt, chat_history, summary=summary)[0]
+
+def generate_reply(model_name, prompt, chat_history=None, max_retries=3, summary=None):
+    """Call the Hugging Face API and return (reply, ok); ok is False for error replies"""
+    full_prompt = build_full_prompt(model_name, prompt, chat_history, summary)
+    
+    # Models served in-process skip the remote API unless the local engine is unavailable
+    local = local_reply(model_name, full_prompt)
+    if local is not None:
+        return local
+    
+    # Check API key
+    if not HF_API_KEY:
+        return "Error: Hugging Face API key not set. Please set HUGGINGFACE_API_KEY environment variable.", False
+    
+    payload = {
+        "inputs": full_prompt,
+        "parameters": dict(GENERATION_PARAMETERS)
+    }
+    
+    cache_key = response_cache.make_key(model_name, payload) if response_cache else None
+    if cache_key:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"Response cache hit for {model_name}")
+            return cached, True
+    
+    fast_reply = fail_fast_response(model_name)
+    if fast_reply:
+        logger.info(f"Failing fast for {model_name}: recently unavailable")
+        return fast_reply, False
+    
+    url = f"{HF_API_BASE}{model_name}"
+    
+    if single_flight is None:
+        return _request_generation(model_name, url, payload, cache_key, max_retries)
+    
+    # Identical concurrent requests share one upstream call
+    return single_flight.do(
+        payload_key(model_name, payload),
+        lambda: _request_generation(model_name, url, payload, cache_key, max_retries)
+    )
+
+def _request_generation(model_name, url, payload, cache_key, max_retries):
+    # Retry logic for API calls
+    for attempt in range(max_retries):
+        if not breaker_allows(model_name):
+            logger.info(f"Circuit open for {model_name}, failing fast")
+            return breaker_open_reply(model_name), False
+        
+        try:
+            logger.info(f"Attempting API call to {model_name} (attempt {attempt + 1})")
+            start_time = time.time()
+            if upstream_batcher is not None:
+                # The batcher records each upstream request itself; a batch is one request, not one per caller
+                response = upstream_batcher.post(model_name, url, payload, timeout=30)
+            else:
+                with upstream_admission(model_name):
+                    start_time = time.time()
+                    response = inference_client.post(url, json=payload, timeout=30)
+                record_upstream_outcome(model_name, response.status_code, time.time() - start_time)
+            
+            logger.info(f"Response status: {response.status_code}")
+            
             if response.status_code == 200:
                 result = response.json()
-                if isinstance(result, list) and len(result) > 0:
-                    generated_text = result[0].get('generated_text', '').strip()
-                    if generated_text:
-                        return generated_text
-                    else:
-                        return "I apologize, but I couldn't generate a proper response. Please try rephrasing your question."
-                else:
-                    return "I received an unexpected response format. Please try again."
+                generated_text = extract_generated_text(result)
+                if cache_key and generated_text:
+                    response_cache.put(cache_key, model_name, generated_text)
+                return parse_generated_text(result), bool(generated_text)
                     
             elif response.status_code == 404:
                 logger.error(f"Model not found: {model_name}")
-                return f"Error: Model '{model_name}' not found. This model may not exist or may not be available via the Inference API."
+                return f"Error: Model '{model_name}' not found. This model may not exist or may not be available via the Inference API.", False
                 
             elif response.status_code == 503:
                 # Model loading
                 if attempt < max_retries - 1:
+                    UPSTREAM_RETRIES.inc(model_name, 'loading')
                     wait_time = 5 * (attempt + 1)
                     logger.info(f"Model loading, waiting {wait_time} seconds...")
                     time.sleep(wait_time)
                     continue
                 else:
-                    return "The AI model is currently loading. Please try again in a few moments."
+                    return "The AI model is currently loading. Please try again in a few moments.", False
                     
             elif response.status_code == 429:
                 # Rate limit
                 if attempt < max_retries - 1:
+                    UPSTREAM_RETRIES.inc(model_name, 'rate_limited')
                     wait_time = 10 * (attempt + 1)
                     logger.info(f"Rate limited, waiting {wait_time} seconds...")
                     time.sleep(wait_time)
                     continue
                 else:
-                    return "I'm currently experiencing high traffic. Please try again in a moment."
+                    return "I'm currently experiencing high traffic. Please try again in a moment.", False
                     
             elif response.status_code == 401:
-                return "Error: Invalid API key. Please check your HUGGINGFACE_API_KEY."
+                return "Error: Invalid API key. Please check your HUGGINGFACE_API_KEY.", False
                 
             else:
                 logger.error(f"API error: {response.status_code} - {response.text}")
-                return f"I encountered an error (code {response.status_code}): {response.text[:200]}"
+                return f"I encountered an error (code {response.status_code}): {response.text[:200]}", False
                 
         except requests.exceptions.Timeout:
+            if upstream_batcher is None:
+                record_upstream_outcome(model_name, None, time.time() - start_time)
             if attempt < max_retries - 1:
+                UPSTREAM_RETRIES.inc(model_name, 'timeout')
                 logger.info("Request timeout, retrying...")
                 time.sleep(2)
                 continue
             else:
-                return "The request timed out. Please try again."
+                return "The request timed out. Please try again.", False
                 
         except requests.exceptions.RequestException as e:
+            if upstream_batcher is None:
+                record_upstream_outcome(model_name, None, time.time() - start_time)
+            logger.error(f"Request error: {str(e)}")
+            return f"I'm having trouble connecting to the AI service: {str(e)}", False
+    
+    return "I'm unable to process your request right now. Please try again later.", False
+
+def routing_candidates(model=None, category=None, allow_fallback=False):
+    """Models to try in order for a chat request, or None if the request is invalid"""
+    if category:
+        if category not in MODEL_CATEGORIES:
+            return None
+        return model_monitor.rank([name for name, info in MODELS_CONFIG.items() if info['category'] == category])
+    
+    if model not in MODELS_CONFIG:
+        return None
+    if not allow_fallback:
+        return [model]
+    
+    # Requested model first, then the rest of its tier by recent performance
+    tier = MODELS_CONFIG[model]['category']
+    return [model] + model_monitor.rank([name for name, info in MODELS_CONFIG.items() if info['category'] == tier and name != model])
+
+def routed_reply(candidates, prompt, chat_history=None, summary=None):
+    """Try candidates in order until one answers; returns (model, reply)"""
+    for index, model_name in enumerate(candidates):
+        last = index == len(candidates) - 1
+        if not last and (model_monitor.known_down(model_name) or (circuit_breakers is not None and circuit_breakers.is_open(model_name))):
+            logger.info(f"Routing: skipping {model_name}, recently unavailable")
+            continue
+        # Only the final candidate is allowed to sit through retry back-off
+        try:
+            reply, ok = generate_reply(model_name, prompt, chat_history, max_retries=3 if last else 1, summary=summary)
+        except AdmissionRejected:
+            if last:
+                raise
+            logger.info(f"Routing: {model_name} is saturated, falling back")
+            continue
+        if ok or last:
+            return model_name, reply
+        logger.info(f"Routing: {model_name} failed, falling back")
+
+def stream_huggingface_api(model_name, prompt, chat_history=None, summary=None):
+    """Yield generated text chunks from the Hugging Face API as they arrive"""
+    if local_engine is not None and local_engine.serves(model_name):
+        yield call_huggingface_api(model_name, prompt, chat_history, summary)  # One chunk per local batch
+        return
+    
+    if not HF_API_KEY:
+        yield "Error: Hugging Face API key not set. Please set HUGGINGFACE_API_KEY environment variable."
+        return
+    
+    payload = {
+        "inputs": build_full_prompt(model_name, prompt, chat_history, summary),
+        "parameters": dict(GENERATION_PARAMETERS),
+        "stream": True
+    }
+    url = f"{HF_API_BASE}{model_name}"
+    
+    if not breaker_allows(model_name):
+        yield breaker_open_reply(model_name)
+        return
+    
+    with upstream_admission(model_name):
+        try:
+            logger.info(f"Opening token stream to {model_name}")
+            start_time = time.time()
+            response = inference_client.post(url, json=payload, timeout=30, stream=True)
+        except requests.exceptions.RequestException as e:
+            record_upstream_outcome(model_name, None)
+            logger.error(f"Stream request error: {str(e)}")
+            yield f"I'm having trouble connecting to the AI service: {str(e)}"
+            return
+        
+        with response:
+            content_type = response.headers.get('Content-Type', '')
+            if response.status_code == 200 and 'text/event-stream' in content_type:
+                record_upstream_outcome(model_name, 200, time.time() - start_time)
+                yield from _iter_stream_tokens(model_name, response)
+                return
+            
+            if response.status_code == 200:
+                # Models without streaming support answer with the whole generation at once
+                try:
+                    result = response.json()
+                except ValueError:
+                    result = None
+                if result is not None:
+                    record_upstream_outcome(model_name, 200, time.time() - start_time)
+                    yield parse_generated_text(result)
+                    return
+            
+            # Still a real upstream attempt: the monitor and breaker must see it
+            status = response.status_code
+            record_upstream_outcome(model_name, status, time.time() - start_time)
+    
+    # Errors and cold starts go through the regular path so retries and
+    # error messages stay identical
+    if status in (503, 429):
+        # The stream request was the first attempt; back off as the regular path would before its second
+        reason, wait_time = ('loading', 5) if status == 503 else ('rate_limited', 10)
+        UPSTREAM_RETRIES.inc(model_name, reason)
+        logger.info(f"Stream to {model_name} got {status}, waiting {wait_time} seconds before retrying...")
+        time.sleep(wait_time)
+        yield generate_reply(model_name, prompt, chat_history, max_retries=2, summary=summary)[0]
+        return
+    yield call_huggingface_api(model_name, prompt, chat_history, summary)
+
+def _iter_stream_tokens(model_name, response):
+    produced = False
+    for line in response.iter_lines(chunk_size=None):
+        if not line or not line.startswith(b'data:'):
+            continue
+        try:
+            event = json.loads(line[len(b'data:'):].decode('utf-8'))
+        except ValueError:
+            continue
+        
+        if event.get('error'):
+            logger.error(f"Stream error from {model_name}: {event['error']}")
+            yield f"I encountered an error: {event['error'][:200]}"
+            return
+        
+        token = event.get('token') or {}
+        if token.get('special') or not token.get('text'):
+            continue
+        produced = True
+        yield token['text']
+    
+    if not produced:
+        yield "I apologize, but I couldn't generate a proper response. Please try rephrasing your question."
+
+def format_sse(data, event=None):
+    """Format a JSON payload as a Server-Sent Events message"""
+    message = f"data: {json.dumps(data)}\n\n"
+    if event:
+        message = f"event: {event}\n{message}"
+    return message
+
+def retry_delay(base_seconds, attempt):
+    """Linear backoff with equal jitter so concurrent retries spread out"""
+    delay = base_seconds * (attempt + 1)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+async def async_call_huggingface_api(session, model_name, prompt, chat_history=None, summary=None):
+    """Non-blocking variant of call_huggingface_api for the asyncio chat path"""
+    full_prompt = build_full_prompt(model_name, prompt, chat_history, summary)
+    
+    if local_engine is not None and local_engine.serves(model_name):
+        try:
+            text = await asyncio.wait_for(
+                asyncio.wrap_future(local_engine.submit(model_name, full_prompt)), local_engine.timeout)
+            return parse_generated_text([{'generated_text': text}])
+        except (LocalInferenceError, asyncio.TimeoutError) as e:
+            logger.info(f"Local inference for {model_name} unavailable, using remote API: {str(e)}")
+    
+    if not HF_API_KEY:
+        return "Error: Hugging Face API key not set. Please set HUGGINGFACE_API_KEY environment variable."
+    
+    payload = {
+        "inputs": full_prompt,
+        "parameters": dict(GENERATION_PARAMETERS)
+    }
+    
+    cache_key = response_cache.make_key(model_name, payload) if response_cache else None
+    if cache_key:
+        cached = await asyncio.to_thread(response_cache.get, cache_key)
+        if cached is not None:
+            return cached
+    
+    fast_reply = fail_fast_response(model_name)
+    if fast_reply:
+        return fast_reply
+    
+    url = f"{HF_API_BASE}{model_name}"
+    timeout = aiohttp.ClientTimeout(total=30)
+    
+    max_retries = 3
+    for attempt in range(max_retries):
+        if not breaker_allows(model_name):
+            return breaker_open_reply(model_name)
+        
+        try:
+            logger.info(f"Attempting async API call to {model_name} (attempt {attempt + 1})")
+            async with async_upstream_admission(model_name):
+                start_time = time.time()
+                async with session.post(url, json=payload, timeout=timeout) as response:
+                    status = response.status
+                    record_upstream_outcome(model_name, status, time.time() - start_time)
+                    if status == 200:
+                        result = await response.json(content_type=None)
+                    else:
+                        body = await response.text()
+            
+            if status == 200:
+                if cache_key and extract_generated_text(result):
+                    await asyncio.to_thread(response_cache.put, cache_key, model_name, extract_generated_text(result))
+                return parse_generated_text(result)
+            
+            logger.info(f"Response status: {status}")
+            
+            if status == 404:
+                logger.error(f"Model not found: {model_name}")
+                return f"Error: Model '{model_name}' not found. This model may not exist or may not be available via the Inference API."
+            
+            elif status == 503:
+                # Model loading - yield the event loop instead of the worker thread
+                if attempt < max_retries - 1:
+                    UPSTREAM_RETRIES.inc(model_name, 'loading')
+                    wait_time = retry_delay(5, attempt)
+                    logger.info(f"Model loading, waiting {wait_time:.1f} seconds...")
+                    await asyncio.sleep(wait_time)
+                    continue
+                else:
+                    return "The AI model is currently loading. Please try again in a few moments."
+            
+            elif status == 429:
+                if attempt < max_retries - 1:
+                    UPSTREAM_RETRIES.inc(model_name, 'rate_limited')
+                    wait_time = retry_delay(10, attempt)
+                    logger.info(f"Rate limited, waiting {wait_time:.1f} seconds...")
+                    await asyncio.sleep(wait_time)
+                    continue
+                else:
+                    return "I'm currently experiencing high traffic. Please try again in a moment."
+            
+            elif status == 401:
+                return "Error: Invalid API key. Please check your HUGGINGFACE_API_KEY."
+            
+            else:
+                logger.error(f"API error: {status} - {body}")
+                return f"I encountered an error (code {status}): {body[:200]}"
+        
+        except asyncio.TimeoutError:
+            record_upstream_outcome(model_name, None, time.time() - start_time)
+            if attempt < max_retries - 1:
+                UPSTREAM_RETRIES.inc(model_name, 'timeout')
+                logger.info("Request timeout, retrying...")
+                await asyncio.sleep(retry_delay(2, 0))
+                continue
+            else:
+                return "The request timed out. Please try again."
+        
+        except aiohttp.ClientError as e:
+            record_upstream_outcome(model_name, None, time.time() - start_time)
             logger.error(f"Request error: {str(e)}")
             return f"I'm having trouble connecting to the AI service: {str(e)}"
     
     return "I'm unable to process your request right now. Please try again later."
 
+async def async_get_chat_memory(chat_id, limit=CHAT_MEMORY_LIMIT):
+    """Read chat history off the event loop"""
+    return await asyncio.to_thread(get_chat_memory, chat_id, limit)
+
+async def async_save_chat_message(chat_id, model, user_message, bot_response, latency_ms=None):
+    """Write a chat message off the event loop"""
+    await asyncio.to_thread(save_chat_message, chat_id, model, user_message, bot_response, latency_ms)
+
+async def async_chat_turn(session, chat_id, model, message):
+    """Run one full chat turn (history, upstream call, save) without blocking"""
+    chat_history = await async_get_chat_memory(chat_id)
+    summary = await asyncio.to_thread(get_chat_summary, chat_id) if CONTEXT_SUMMARIES_ENABLED else None
+    started = time.monotonic()
+    response = await async_call_huggingface_api(session, model, message, chat_history, summary)
+    await async_save_chat_message(chat_id, model, message, response, (time.monotonic() - started) * 1000)
+    if CONTEXT_SUMMARIES_ENABLED:
+        await asyncio.to_thread(update_chat_summary, chat_id)
+    return response
+
+def create_async_session(max_connections=ASYNC_MAX_CONNECTIONS):
+    """Create the aiohttp session used by the async chat path (call inside a running loop)"""
+    connector = aiohttp.TCPConnector(limit=max_connections, keepalive_timeout=30)
+    return aiohttp.ClientSession(connector=connector, headers=inference_client.auth_headers)
+
+class AsyncChatRuntime:
+    """Process-wide event loop thread that multiplexes upstream calls for Flask workers"""
+
+    def __init__(self, max_connections=ASYNC_MAX_CONNECTIONS):
+        self.max_connections = max_connections
+        self.loop = None
+        self.session = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self.loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='async-chat-loop', daemon=True).start()
+            self.session = asyncio.run_coroutine_threadsafe(self._open_session(), loop).result()
+            self.loop = loop
+            logger.info(f"Async chat runtime started (max connections: {self.max_connections})")
+
+    async def _open_session(self):
+        return create_async_session(self.max_connections)
+
+    def submit(self, coro_factory):
+        """Schedule coro_factory(session) on the loop and return a concurrent Future"""
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro_factory(self.session), self.loop)
+
+    def run(self, coro_factory, timeout=ASYNC_REQUEST_TIMEOUT):
+        return self.submit(coro_factory).result(timeout)
+
+    def stop(self):
+        with self._lock:
+            if self.loop is None:
+                return
+            asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop = None
+            self.session = None
+
+async_runtime = AsyncChatRuntime()
+
+def admission_rejected_response(error):
+    """503 response telling the client when to retry a rejected upstream call"""
+    logger.info(str(error))
+    response = jsonify({
+        'error': 'The AI service is busy. Please try again shortly.',
+        'reason': error.reason,
+        'model': error.model_name
+    })
+    response.headers['Retry-After'] = str(max(1, int(round(error.retry_after))))
+    return response, 503
+
+class WorkerLifecycle:
+    """In-flight request count and drain state of this process, for graceful shutdown"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.draining = False
+        self._inflight = 0
+        self._idle = threading.Condition()
+
+    @property
+    def inflight(self):
+        with self._idle:
+            return self._inflight
+
+    def begin(self):
+        with self._idle:
+            self._inflight += 1
+
+    def end(self):
+        with self._idle:
+            self._inflight -= 1
+            if self._inflight == 0:
+                self._idle.notify_all()
+
+    def begin_drain(self):
+        """Fail readiness from now on; requests already accepted still complete"""
+        self.draining = True
+
+    def wait_idle(self, timeout):
+        """Block until no request is in flight; returns False if timeout expired first"""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._inflight == 0, timeout)
+
+lifecycle = WorkerLifecycle()
+
+# Probes must answer even while the schema is missing or the process is draining
+PROBE_ENDPOINTS = ('liveness', 'readiness')
+
+def start_background_jobs():
+    """Process-wide singleton jobs (run them in one process only when pre-forking)"""
+    if MODEL_PROBER_ENABLED:
+        model_monitor.start()
+    if RETENTION_ENABLED:
+        retention_engine.start()
+
+def init_worker(worker_index=0, single_process=False):
+    """Per-process setup after fork: threads do not survive fork, so recreate what needs them"""
+    global write_behind, context_cache
+    random.seed()  # Otherwise every worker draws the same retry jitter
+    db_pool.close_all()
+    if context_cache is not None and not single_process:
+        # Each worker would cache history independently of writes and clears made by the others
+        context_cache = None
+        if worker_index == 0:
+            logger.info("Chat context cache disabled: it is per process and cannot see other workers' writes")
+    if WRITE_BEHIND_ENABLED:
+        write_behind = WriteBehindQueue()
+        write_behind.start()
+        atexit.register(write_behind.stop)
+    if worker_index == 0:
+        start_background_jobs()
+
+def shutdown_services(timeout=10):
+    """Stop background threads, flush write-behind rows and close connections (idempotent)"""
+    model_monitor.stop()
+    retention_engine.stop()
+    if local_engine is not None:
+        local_engine.stop()
+    async_runtime.stop()
+    if write_behind is not None:
+        write_behind.stop(timeout)
+    db_pool.close_all()
+
+@app.before_request
+def start_request_timer():
+    request.environ['app.start_time'] = time.perf_counter()
+    if request.endpoint in PROBE_ENDPOINTS:
+        return
+    # WSGI servers import the module without running __main__, so the schema is created lazily
+    ensure_database()
+
+class InflightMiddleware:
+    """Counts a request as in flight until the server closes its response, i.e. after the last byte
+
+    Teardown hooks run when a streamed body's generator finishes, before the
+    server writes the terminating chunk, so they would let a drain end early.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') in ('/livez', '/readyz'):
+            return self.wsgi_app(environ, start_response)
+        lifecycle.begin()
+        try:
+            body = self.wsgi_app(environ, start_response)
+        except BaseException:
+            lifecycle.end()
+            raise
+        return ClosingIterator(body, lifecycle.end)
+
+app.wsgi_app = InflightMiddleware(app.wsgi_app)
+
+@app.after_request
+def record_request_latency(response):
+    """Observe the end-to-end handler time (for streams, until the first byte is ready)"""
+    start = request.environ.get('app.start_time')
+    if start is not None:
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint, request.method, str(response.status_code))
+    if lifecycle.draining:
+        response.headers['Connection'] = 'close'  # Don't keep connections to a worker that is going away
+    return response
+
+metrics.gauge('write_behind_queue_depth', 'Chat messages waiting for the write-behind flusher',
+              lambda: write_behind.depth() if write_behind is not None else 0)
+metrics.gauge('admission_queue_depth', 'Upstream calls waiting for a model slot',
+              lambda: admission_controller.get_stats()['queue_depth'] if admission_controller is not None else 0)
+
+class StaticAsset:
+    """A file held in memory with precompressed variants, reloaded when its mtime changes
+
+    The mtime is checked at most every reload_interval seconds, so a page
+    load normally costs neither a disk read nor a compression pass.
+    """
+
+    def __init__(self, path, mimetype, cache_control=INDEX_CACHE_CONTROL, reload_interval=INDEX_RELOAD_INTERVAL):
+        self.path = path
+        self.mimetype = mimetype
+        self.cache_control = cache_control
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._variants = None  # encoding -> (body, etag)
+        self._mtime = None
+        self._checked = 0.0
+
+    def _load(self, mtime):
+        with open(self.path, 'rb') as f:
+            body = f.read()
+        digest = hashlib.sha256(body).hexdigest()[:20]
+        variants = {'identity': (body, f'"{digest}"')}
+        variants['gzip'] = (gzip.compress(body, compresslevel=9, mtime=0), f'"{digest}-gzip"')
+        if brotli is not None:
+            variants['br'] = (brotli.compress(body, quality=11), f'"{digest}-br"')
+        self._variants = variants
+        self._mtime = mtime
+        logger.info(f"Loaded {self.path} ({len(body)} bytes, encodings: {', '.join(variants)})")
+
+    def variants(self):
+        """Current variants, or None if the file does not exist"""
+        now = time.monotonic()
+        if self._variants is not None and now - self._checked < self.reload_interval:
+            return self._variants
+        with self._lock:
+            if self._variants is None or now - self._checked >= self.reload_interval:
+                self._checked = now
+                try:
+                    mtime = os.stat(self.path).st_mtime_ns
+                    if mtime != self._mtime:
+                        self._load(mtime)
+                except FileNotFoundError:
+                    self._variants = None
+                    self._mtime = None
+            return self._variants
+
+    def respond(self):
+        """Response for the current request: negotiated encoding, ETag and 304 handling"""
+        variants = self.variants()
+        if variants is None:
+            return None
+        
+        encoding = 'identity'
+        for candidate in ('br', 'gzip'):
+            if candidate in variants and request.accept_encodings[candidate] > 0:
+                encoding = candidate
+                break
+        body, etag = variants[encoding]
+        
+        headers = {
+            'ETag': etag,
+            'Cache-Control': self.cache_control,
+            'Vary': 'Accept-Encoding'
+        }
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        
+        # If-None-Match uses the weak comparison, so W/ prefixes are ignored
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match:
+            tags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+            if '*' in tags or etag in tags:
+                return Response(status=304, headers=headers)
+        
+        return Response(body, mimetype=self.mimetype, headers=headers)
+
+index_asset = StaticAsset(INDEX_PATH, 'text/html')
+
 # Routes
 @app.route('/')
 def index():
     """Serve the main HTML page"""
-    try:
-        with open('index.html', 'r', encoding='utf-8') as f:
-            html_content = f.read()
-        return html_content
-    except FileNotFoundError:
-        return """
-        <html>
-        <head><title>AI Platform Error</title></head>
-        <body>
-            <h1>AI Platform</h1>
-            <p>Error: index.html file not found. Please create the frontend file.</p>
-            <p>API is running at: <a href="/api/health">/api/health</a></p>
-            <p>Debug models at: <a href="/api/debug/gpt2">/api/debug/gpt2</a></p>
-        </body>
-        </html>
-        """
+    response = index_asset.respond()
+    if response is not None:
+        return response
+    
+    return """
+    <html>
+    <head><title>AI Platform Error</title></head>
+    <body>
+        <h1>AI Platform</h1>
+        <p>Error: index.html file not found. Please create the frontend file.</p>
+        <p>API is running at: <a href="/api/health">/api/health</a></p>
+        <p>Debug models at: <a href="/api/debug/gpt2">/api/debug/gpt2</a></p>
+    </body>
+    </html>
+    """
 
 @app.route('/api/models')
 def get_models():
     """Get available models configuration"""
-    return jsonify(MODELS_CONFIG)
+    return jsonify({
+        model_name: dict(
+            config,
+            health=model_monitor.get_status(model_name),
+            served_locally=bool(local_engine and local_engine.serves(model_name)),
+            circuit_breaker=circuit_breakers.get(model_name).snapshot() if circuit_breakers else None
+        )
+        for model_name, config in MODELS_CONFIG.items()
+    })
 
 @app.route('/api/chat', methods=['POST'])
 def chat():
@@ -408,32 +3386,128 @@ def chat():
         chat_id = data.get('chat_id')
         model = data.get('model')
         message = data.get('message')
+        category = data.get('category')  # Route to the best model in a speed tier
+        allow_fallback = bool(data.get('allow_fallback'))
         
-        if not all([chat_id, model, message]):
+        if not all([chat_id, model or category, message]):
             return jsonify({'error': 'Missing required fields'}), 400
-            
-        if model not in MODELS_CONFIG:
+        
+        candidates = routing_candidates(model, category, allow_fallback)
+        if not candidates:
             return jsonify({'error': 'Invalid model'}), 400
         
         # Get chat history for context
         chat_history = get_chat_memory(chat_id)
+        summary = get_chat_summary(chat_id)
         
         # Call AI model
-        response = call_huggingface_api(model, message, chat_history)
+        started = time.monotonic()
+        if len(candidates) == 1:
+            answered_by = candidates[0]
+            response = call_huggingface_api(answered_by, message, chat_history, summary)
+        else:
+            answered_by, response = routed_reply(candidates, message, chat_history, summary)
+        latency_ms = (time.monotonic() - started) * 1000
         
         # Save to database
-        save_chat_message(chat_id, model, message, response)
+        save_chat_message(chat_id, answered_by, message, response, latency_ms)
+        update_chat_summary(chat_id)
         
         return jsonify({
             'response': response,
-            'model': model,
+            'model': answered_by,
+            'requested_model': model or category,
+            'routed': answered_by != model,
             'timestamp': datetime.now().isoformat()
         })
         
+    except AdmissionRejected as e:
+        return admission_rejected_response(e)
+        
     except Exception as e:
         logger.error(f"Chat error: {str(e)}")
         return jsonify({'error': 'Internal server error'}), 500
 
+@app.route('/api/chat/async', methods=['POST'])
+def chat_async():
+    """Handle chat messages on the shared event loop (non-blocking retries)"""
+    try:
+        data = request.json
+        chat_id = data.get('chat_id')
+        model = data.get('model')
+        message = data.get('message')
+        
+        if not all([chat_id, model, message]):
+            return jsonify({'error': 'Missing required fields'}), 400
+            
+        if model not in MODELS_CONFIG:
+            return jsonify({'error': 'Invalid model'}), 400
+        
+        response = async_runtime.run(lambda session: async_chat_turn(session, chat_id, model, message))
+        
+        return jsonify({
+            'response': response,
+            'model': model,
+            'timestamp': datetime.now().isoformat()
+        })
+    
+    except AdmissionRejected as e:
+        return admission_rejected_response(e)
+        
+    except Exception as e:
+        logger.error(f"Async chat error: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    """Handle chat messages, streaming tokens back as Server-Sent Events"""
+    data = request.json or {}
+    chat_id = data.get('chat_id')
+    model = data.get('model')
+    message = data.get('message')
+    
+    if not all([chat_id, model, message]):
+        return jsonify({'error': 'Missing required fields'}), 400
+        
+    if model not in MODELS_CONFIG:
+        return jsonify({'error': 'Invalid model'}), 400
+    
+    try:
+        chat_history = get_chat_memory(chat_id)
+        summary = get_chat_summary(chat_id)
+    except Exception as e:
+        logger.error(f"Chat stream error: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+    
+    def generate():
+        chunks = []
+        started = time.monotonic()
+        try:
+            for chunk in stream_huggingface_api(model, message, chat_history, summary):
+                chunks.append(chunk)
+                yield format_sse({'token': chunk})
+            
+            response = ''.join(chunks).strip()
+            save_chat_message(chat_id, model, message, response, (time.monotonic() - started) * 1000)
+            update_chat_summary(chat_id)
+            yield format_sse({
+                'response': response,
+                'model': model,
+                'timestamp': datetime.now().isoformat()
+            }, event='done')
+        except AdmissionRejected as e:
+            logger.info(str(e))
+            yield format_sse({'error': 'The AI service is busy. Please try again shortly.', 'reason': e.reason}, event='error')
+        except Exception as e:
+            logger.error(f"Chat stream error: {str(e)}")
+            yield format_sse({'error': 'Internal server error'}, event='error')
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 @app.route('/api/chat/<chat_id>/clear', methods=['DELETE'])
 def clear_chat(chat_id):
     """Clear chat memory"""
@@ -444,43 +3518,156 @@ def clear_chat(chat_id):
         logger.error(f"Clear chat error: {str(e)}")
         return jsonify({'error': 'Failed to clear chat memory'}), 500
 
+def history_message(row):
+    return {
+        'id': row[0],
+        'user_message': row[1],
+        'bot_response': row[2],
+        'timestamp': row[3],
+        'model': row[4]
+    }
+
 @app.route('/api/chat/<chat_id>/history')
 def get_chat_history(chat_id):
-    """Get chat history"""
+    """Get chat history (keyset-paginated by message id, or an NDJSON export)"""
     try:
-        history = get_chat_memory(chat_id, limit=50)
-        return jsonify({
+        if write_behind is not None:
+            write_behind.flush()  # Queued messages have no id yet
+        
+        if request.args.get('format') == 'ndjson':
+            def generate():
+                for row in iter_chat_transcript(chat_id):
+                    yield json.dumps(dict(history_message(row), chat_id=chat_id)) + '\n'
+            
+            return Response(
+                stream_with_context(generate()),
+                mimetype='application/x-ndjson',
+                headers={'Content-Disposition': f'attachment; filename="{chat_id}.ndjson"'}
+            )
+        
+        limit = max(1, min(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), HISTORY_MAX_PAGE_SIZE))
+        before = request.args.get('before', type=int)
+        after = request.args.get('after', type=int)
+        
+        with DB_READ_SECONDS.time('history_page'):
+            rows, has_more = get_history_page(chat_id, limit, before=before, after=after)
+        messages = [history_message(row) for row in rows]
+        
+        if after is not None:
+            cursors = {'next_after': messages[-1]['id'] if has_more else None}
+        else:
+            cursors = {'next_before': messages[0]['id'] if has_more else None}
+        
+        return jsonify(dict({
             'chat_id': chat_id,
-            'messages': [
-                {
-                    'user_message': msg[0],
-                    'bot_response': msg[1],
-                    'timestamp': msg[2]
-                } for msg in history
-            ]
-        })
+            'messages': messages,
+            'has_more': has_more
+        }, **cursors))
     except Exception as e:
         logger.error(f"Get history error: {str(e)}")
         return jsonify({'error': 'Failed to retrieve chat history'}), 500
 
+@app.route('/api/search')
+def search():
+    """Ranked full-text search over chat history, optionally within one chat or model"""
+    if not search_available:
+        return jsonify({'error': 'Search is not available on this server'}), 501
+    
+    text = request.args.get('q', '').strip()
+    if not text:
+        return jsonify({'error': 'Missing search query'}), 400
+    
+    try:
+        if write_behind is not None:
+            write_behind.flush()  # Queued messages are not indexed yet
+        
+        limit = max(1, min(request.args.get('limit', SEARCH_PAGE_SIZE, type=int), SEARCH_MAX_PAGE_SIZE))
+        offset = max(0, min(request.args.get('offset', 0, type=int), SEARCH_MAX_OFFSET))
+        order = request.args.get('order', 'rank')
+        if order not in ('rank', 'recent'):
+            return jsonify({'error': "order must be 'rank' or 'recent'"}), 400
+        
+        with DB_READ_SECONDS.time('search'):
+            rows, has_more = search_messages(
+                text,
+                chat_id=request.args.get('chat_id'),
+                model=request.args.get('model'),
+                limit=limit,
+                offset=offset,
+                order=order
+            )
+        
+        return jsonify({
+            'query': text,
+            'order': order,
+            'results': [{
+                'id': row[0],
+                'chat_id': row[1],
+                'model': row[2],
+                'timestamp': row[3],
+                'user_message': row[4],
+                'bot_response': row[5],
+                'score': round(-row[6], 4)  # bm25() is lower-is-better; flip it for readers
+            } for row in rows],
+            'has_more': has_more,
+            'next_offset': offset + len(rows) if has_more and offset + len(rows) <= SEARCH_MAX_OFFSET else None
+        })
+    except Exception as e:
+        logger.error(f"Search error: {str(e)}")
+        return jsonify({'error': 'Search failed'}), 500
+
 @app.route('/api/debug/<model_name>')
 def debug_model(model_name):
     """Debug endpoint to check model availability and API connectivity"""
     result = debug_huggingface_api(model_name)
     return jsonify(result)
 
+def fan_out_models(task, model_names, concurrency=FANOUT_CONCURRENCY):
+    """Run task(model_name) across models concurrently, yielding results as they finish"""
+    def rate_limited(model_name):
+        fanout_bucket.acquire()
+        return task(model_name)
+    
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix='fanout') as executor:
+        futures = {executor.submit(rate_limited, name): name for name in model_names}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+def get_fanout_concurrency():
+    """Sweep concurrency from ?concurrency=, capped at FANOUT_MAX_CONCURRENCY"""
+    requested = request.args.get('concurrency', type=int) or FANOUT_CONCURRENCY
+    return max(1, min(requested, FANOUT_MAX_CONCURRENCY))
+
+def wants_stream():
+    return request.args.get('stream', 'false').lower() == 'true'
+
+def stream_sweep(results, summary):
+    """SSE response with one 'result' event per model and a final 'done' event"""
+    def generate():
+        for model_name, result in results:
+            yield format_sse({'model': model_name, 'result': result}, event='result')
+        yield format_sse(dict(summary, timestamp=datetime.now().isoformat()), event='done')
+    
+    # stream_with_context keeps the request (and its in-flight count for graceful drain) open until the last event
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def debug_model_task(model_name):
+    logger.info(f"Debugging model: {model_name}")
+    return debug_huggingface_api(model_name)
+
 @app.route('/api/debug/all')
 def debug_all_models():
     """Debug all models to see which ones work"""
-    results = {}
+    model_names = list(MODELS_CONFIG.keys())
+    results = fan_out_models(debug_model_task, model_names, get_fanout_concurrency())
     
-    for model_name in MODELS_CONFIG.keys():
-        logger.info(f"Debugging model: {model_name}")
-        results[model_name] = debug_huggingface_api(model_name)
-        time.sleep(1)  # Small delay to avoid rate limiting
+    if wants_stream():
+        return stream_sweep(results, {'api_key_configured': bool(HF_API_KEY and len(HF_API_KEY) > 10)})
     
+    collected = dict(results)
     return jsonify({
-        'debug_results': results,
+        'debug_results': {name: collected[name] for name in model_names},
         'api_key_configured': bool(HF_API_KEY and len(HF_API_KEY) > 10),
         'timestamp': datetime.now().isoformat()
     })
@@ -515,6 +3702,9 @@ def test_model(model_name):
             'api_key_configured': bool(HF_API_KEY and len(HF_API_KEY) > 10)
         })
         
+    except AdmissionRejected as e:
+        return admission_rejected_response(e)
+        
     except Exception as e:
         logger.error(f"Test model error: {str(e)}")
         return jsonify({
@@ -524,43 +3714,50 @@ def test_model(model_name):
             'timestamp': datetime.now().isoformat()
         }), 500
 
+def test_model_task(model_name, test_prompt):
+    """Run the test prompt against one model and describe the outcome"""
+    model_info = MODELS_CONFIG[model_name]
+    try:
+        logger.info(f"Testing model: {model_name}")
+        start_time = time.time()
+        
+        response = call_huggingface_api(model_name, test_prompt)
+        
+        end_time = time.time()
+        response_time = round(end_time - start_time, 2)
+        
+        return {
+            'model_info': model_info,
+            'response': response,
+            'response_time_seconds': response_time,
+            'status': 'success' if not response.startswith('Error:') else 'failed'
+        }
+        
+    except Exception as e:
+        logger.error(f"Error testing {model_name}: {str(e)}")
+        return {
+            'model_info': model_info,
+            'error': str(e),
+            'status': 'failed'
+        }
+
 @app.route('/api/test/all')
 def test_all_models():
     """Test all available models with enhanced error reporting"""
-    results = {}
     test_prompt = "Write a simple hello world function in Python."
+    model_names = list(MODELS_CONFIG.keys())
+    results = fan_out_models(lambda name: test_model_task(name, test_prompt), model_names, get_fanout_concurrency())
     
-    for model_name, model_info in MODELS_CONFIG.items():
-        try:
-            logger.info(f"Testing model: {model_name}")
-            start_time = time.time()
-            
-            response = call_huggingface_api(model_name, test_prompt)
-            
-            end_time = time.time()
-            response_time = round(end_time - start_time, 2)
-            
-            results[model_name] = {
-                'model_info': model_info,
-                'response': response,
-                'response_time_seconds': response_time,
-                'status': 'success' if not response.startswith('Error:') else 'failed'
-            }
-            
-        except Exception as e:
-            logger.error(f"Error testing {model_name}: {str(e)}")
-            results[model_name] = {
-                'model_info': model_info,
-                'error': str(e),
-                'status': 'failed'
-            }
-        
-        # Small delay between tests to avoid rate limiting
-        time.sleep(1)
+    if wants_stream():
+        return stream_sweep(results, {
+            'test_prompt': test_prompt,
+            'api_key_configured': bool(HF_API_KEY and len(HF_API_KEY) > 10)
+        })
     
+    collected = dict(results)
     return jsonify({
         'test_prompt': test_prompt,
-        'results': results,
+        'results': {name: collected[name] for name in model_names},
         'api_key_configured': bool(HF_API_KEY and len(HF_API_KEY) > 10),
         'timestamp': datetime.now().isoformat()
     })
@@ -574,41 +3771,76 @@ def health_check():
         'models_count': len(MODELS_CONFIG),
         'database_path': DATABASE_PATH,
         'api_key_configured': bool(HF_API_KEY and len(HF_API_KEY) > 10),
-        'api_key_length': len(HF_API_KEY) if HF_API_KEY else 0
+        'api_key_length': len(HF_API_KEY) if HF_API_KEY else 0,
+        'connection_pool': inference_client.get_metrics(),
+        'database_connections': {'open': db_pool.open_connections(), 'opened': db_pool.opened},
+        'write_behind': dict(write_behind.stats, queue_depth=write_behind.depth()) if write_behind else None,
+        'context_cache': context_cache.get_stats() if context_cache else None,
+        'response_cache': response_cache.get_stats() if response_cache else None,
+        'single_flight': single_flight.get_stats() if single_flight else None,
+        'admission': admission_controller.get_stats() if admission_controller else None,
+        'circuit_breakers': circuit_breakers.snapshot() if circuit_breakers else None,
+        'local_inference': local_engine.get_stats() if local_engine else None,
+        'upstream_batching': upstream_batcher.get_stats() if upstream_batcher else None,
+        'retention': retention_engine.last_report
     })
 
+@app.route('/livez')
+def liveness():
+    """Liveness probe: the process is up and serving; touches neither the database nor upstream"""
+    return jsonify({
+        'status': 'alive',
+        'pid': os.getpid(),
+        'uptime_seconds': round(time.time() - lifecycle.started, 1)
+    })
+
+@app.route('/readyz')
+def readiness():
+    """Readiness probe: schema in place, every shard answers, and the process is not draining"""
+    problems = []
+    if lifecycle.draining:
+        problems.append('draining')
+    else:
+        try:
+            ensure_database()
+            for conn in shard_connections():
+                conn.execute('SELECT 1').fetchone()
+        except sqlite3.Error as e:
+            problems.append(f"database: {str(e)}")
+    
+    return jsonify({
+        'status': 'not ready' if problems else 'ready',
+        'problems': problems,
+        'pid': os.getpid(),
+        'inflight': lifecycle.inflight
+    }), 503 if problems else 200
+
 @app.route('/api/stats')
 def get_stats():
     """Get platform statistics"""
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
-        # Get total chats
-        cursor.execute('SELECT COUNT(*) FROM chat_sessions')
-        total_chats = cursor.fetchone()[0]
-        
-        # Get total messages
-        cursor.execute('SELECT COUNT(*) FROM chat_messages')
-        total_messages = cursor.fetchone()[0]
-        
-        # Get most used models
-        cursor.execute('''
-            SELECT model, COUNT(*) as usage_count 
-            FROM chat_messages 
-            GROUP BY model 
-            ORDER BY usage_count DESC 
-            LIMIT 5
-        ''')
-        popular_models = cursor.fetchall()
+        hours = max(1, min(request.args.get('hours', 24, type=int), STATS_MAX_ROLLUP_HOURS))
         
-        conn.close()
+        with DB_READ_SECONDS.time('stats'):
+            # Totals are maintained by triggers, so no table scans here; shards are summed
+            totals = {}
+            for conn in shard_connections():
+                for name, value in conn.execute('SELECT name, value FROM stats_totals'):
+                    totals[name] = totals.get(name, 0) + value
+            total_chats = totals.get('total_chats', 0)
+            total_messages = totals.get('total_messages', 0)
+            
+            # Get most used models
+            popular_models = get_popular_models(5)
+            usage_by_hour = get_usage_rollups(hours)
         
         return jsonify({
             'total_chats': total_chats,
             'total_messages': total_messages,
             'popular_models': [{'model': model, 'usage_count': count} for model, count in popular_models],
+            'usage_by_hour': usage_by_hour,
             'available_models': len(MODELS_CONFIG),
+            'database_shards': len(shard_paths()),
             'api_key_configured': bool(HF_API_KEY and len(HF_API_KEY) > 10),
             'timestamp': datetime.now().isoformat()
         })
@@ -617,9 +3849,32 @@ def get_stats():
         logger.error(f"Stats error: {str(e)}")
         return jsonify({'error': 'Failed to retrieve stats'}), 500
 
+@app.route('/metrics')
+def prometheus_metrics():
+    """Latency histograms, retry counters and queue gauges in the Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/maintenance/retention', methods=['GET', 'POST'])
+def retention():
+    """Last retention report (GET) or run a retention pass now (POST)"""
+    if request.method == 'GET':
+        return jsonify({'enabled': RETENTION_ENABLED, 'last_report': retention_engine.last_report})
+    
+    # A pass deletes data, so only deployments that opted in to retention may trigger one
+    if not RETENTION_ENABLED:
+        return jsonify({'error': 'Retention is disabled. Set RETENTION_ENABLED=true to run retention passes.'}), 409
+    
+    try:
+        if write_behind is not None:
+            write_behind.flush()
+        return jsonify(retention_engine.run_once())
+    except (sqlite3.Error, OSError) as e:
+        logger.error(f"Retention error: {str(e)}")
+        return jsonify({'error': 'Retention pass failed'}), 500
+
 if __name__ == '__main__':
-    # Initialize database on startup
-    init_database()
+    # Initialize database on startup (serve.py is the multi-worker alternative to this block)
+    ensure_database()
     
     # Check API key on startup
     if not HF_API_KEY:
@@ -627,6 +3882,9 @@ if __name__ == '__main__':
     else:
         logger.info(f"API key configured (length: {len(HF_API_KEY)})")
     
+    # Start background model probing / warm-up and retention / archival
+    start_background_jobs()
+    
     # Get port from environment variable (for Render.com deployment)
     port = int(os.environ.get('PORT', 5000))
     
@@ -0,0 +1,114 @@
+"""Load benchmark: sync chat path (thread pool) vs async chat path (event loop).
+
+Both paths run full chat turns (history read, upstream call, save) against
+the local fake inference server and a throwaway SQLite database:
+
+    python benchmarks/async_vs_sync.py --requests 400 --latency-ms 200 --sync-workers 16
+
+Results are printed as JSON.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_hf_server import start_in_thread
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(name, latencies, elapsed):
+    return {
+        'path': name,
+        'requests': len(latencies),
+        'elapsed_seconds': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+        'mean_ms': round(statistics.mean(latencies) * 1000, 1)
+    }
+
+
+def run_sync(app, model, total, workers):
+    def turn(i):
+        start = time.perf_counter()
+        chat_id = f"sync_{i}"
+        history = app.get_chat_memory(chat_id)
+        response = app.call_huggingface_api(model, 'Write a hello world function.', history)
+        app.save_chat_message(chat_id, model, 'Write a hello world function.', response)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        latencies = list(pool.map(turn, range(total)))
+    return summarize(f"sync ({workers} threads)", latencies, time.perf_counter() - start)
+
+
+async def run_async(app, model, total):
+    session = app.create_async_session()
+
+    async def turn(i):
+        start = time.perf_counter()
+        await app.async_chat_turn(session, f"async_{i}", model, 'Write a hello world function.')
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    try:
+        latencies = await asyncio.gather(*(turn(i) for i in range(total)))
+    finally:
+        await session.close()
+    return summarize('async (1 event loop)', latencies, time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the sync and async chat paths')
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--latency-ms', type=float, default=200)
+    parser.add_argument('--sync-workers', type=int, default=16, help='Thread count standing in for Flask workers')
+    parser.add_argument('--model', default='gpt2')
+    args = parser.parse_args()
+
+    server = start_in_thread(latency=args.latency_ms / 1000)
+    os.environ['HF_API_BASE'] = f"{server.base_url}/models/"
+    os.environ.setdefault('HUGGINGFACE_API_KEY', 'hf_benchmark_token')
+    # Single-flight would coalesce the identical sync prompts and admission would queue them;
+    # compare the raw paths instead
+    os.environ['SINGLE_FLIGHT_ENABLED'] = 'false'
+    os.environ['ADMISSION_ENABLED'] = 'false'
+
+    import logging
+    logging.disable(logging.INFO)
+    import app
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app.DATABASE_PATH = os.path.join(tmp, 'bench.db')
+        app.init_database()
+
+        results = [
+            run_sync(app, args.model, args.requests, args.sync_workers),
+            asyncio.run(run_async(app, args.model, args.requests))
+        ]
+
+    print(json.dumps({
+        'benchmark': 'async_vs_sync',
+        'upstream_latency_ms': args.latency_ms,
+        'results': results
+    }, indent=2))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
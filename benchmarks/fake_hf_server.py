@@ -0,0 +1,166 @@
+"""Local stand-in for the Hugging Face inference and hub APIs.
+
+Point the app at it with:
+
+    HF_API_BASE=http://127.0.0.1:8081/models/ HF_HUB_API_BASE=http://127.0.0.1:8081/api/models/ python app.py
+
+Latency (with jitter), 503 "model loading" and 429 rate-limit responses
+can be injected to exercise the app's retry paths:
+
+    python benchmarks/fake_hf_server.py --latency-ms 200 --jitter-ms 50 --rate-503 0.05 --rate-429 0.02
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeInferenceHandler(BaseHTTPRequestHandler):
+    """Answers inference POSTs with canned text after a configurable delay"""
+
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like the real API
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.startswith('/api/models/'):
+            self._send_json(200, {'id': self.path[len('/api/models/'):]})
+        else:
+            self._send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        payload = json.loads(self.rfile.read(length) or b'{}')
+        if not self.path.startswith('/models/'):
+            self._send_json(404, {'error': 'Not found'})
+            return
+
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+            roll = server.random.random()
+            delay = max(0.0, server.latency + server.random.uniform(-server.jitter, server.jitter))
+        if roll < server.rate_503:
+            with server.lock:
+                server.injected['503'] += 1
+            self._send_json(503, {'error': 'Model is currently loading', 'estimated_time': 20.0})
+            return
+        if roll < server.rate_503 + server.rate_429:
+            with server.lock:
+                server.injected['429'] += 1
+            self._send_json(429, {'error': 'Rate limit reached. Please retry later.'})
+            return
+
+        inputs = payload.get('inputs', '')
+        if isinstance(inputs, list):
+            # Batched call: one result list per input, with optional per-item failures
+            with server.lock:
+                server.batch_sizes.append(len(inputs))
+                failed = [server.random.random() < server.rate_item_error for _ in inputs]
+            time.sleep(delay)
+            self._send_json(200, [
+                {'error': 'Input could not be processed'} if fail else [{'generated_text': f"{server.reply} ({len(item)} chars in)"}]
+                for item, fail in zip(inputs, failed)
+            ])
+            return
+
+        text = f"{server.reply} ({len(str(inputs))} chars in)"
+        if payload.get('stream'):
+            self._stream_tokens(text)
+            return
+        time.sleep(delay)
+        self._send_json(200, [{'generated_text': text}])
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def _stream_tokens(self, text):
+        """Send text word by word in the text-generation-inference SSE format"""
+        server = self.server
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        tokens = text.split(' ')
+        for index, word in enumerate(tokens):
+            time.sleep(server.token_delay)
+            last = index == len(tokens) - 1
+            event = {
+                'index': index,
+                'token': {'id': index, 'text': word if index == 0 else f" {word}", 'special': False},
+                'generated_text': text if last else None
+            }
+            self._write_chunk(f"data:{json.dumps(event)}\n\n".encode('utf-8'))
+        self._write_chunk(b'')
+
+
+class FakeInferenceServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # Load tests open hundreds of connections at once
+
+    def __init__(self, address, latency=0.05, token_delay=0.005, reply='Hello from the fake inference server',
+                 jitter=0.0, rate_503=0.0, rate_429=0.0, rate_item_error=0.0, seed=None):
+        super().__init__(address, FakeInferenceHandler)
+        self.latency = latency
+        self.token_delay = token_delay
+        self.reply = reply
+        self.jitter = jitter
+        self.rate_503 = rate_503
+        self.rate_429 = rate_429
+        self.rate_item_error = rate_item_error  # Per input of a batched call
+        self.random = random.Random(seed)  # Seeded runs inject the same error sequence
+        self.request_count = 0
+        self.injected = {'503': 0, '429': 0}
+        self.batch_sizes = []
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+def start_in_thread(port=0, **kwargs):
+    """Start a fake server on a background thread and return it"""
+    server = FakeInferenceServer(('127.0.0.1', port), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--token-delay-ms', type=float, default=5, help='Delay between streamed tokens')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='Uniform +/- jitter added to the latency')
+    parser.add_argument('--rate-503', type=float, default=0, help='Fraction of inference calls answered 503 (loading)')
+    parser.add_argument('--rate-429', type=float, default=0, help='Fraction of inference calls answered 429 (rate limited)')
+    parser.add_argument('--rate-item-error', type=float, default=0, help='Fraction of batched inputs answered with an error')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    server = FakeInferenceServer(
+        ('127.0.0.1', args.port),
+        latency=args.latency_ms / 1000,
+        token_delay=args.token_delay_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        rate_503=args.rate_503,
+        rate_429=args.rate_429,
+        rate_item_error=args.rate_item_error,
+        seed=args.seed
+    )
+    print(f"Fake inference server listening on {server.base_url}")
+    server.serve_forever()
@@ -0,0 +1,168 @@
+"""Benchmark: /api/search (FTS5) query latency against a LIKE scan.
+
+Fills a temporary database with synthetic chat messages through the real
+schema, so the FTS5 triggers index them exactly as live traffic would.
+It then times ranked searches and, for comparison, the equivalent LIKE
+scan:
+
+    python benchmarks/fts_search.py --messages 1000000 --repeat 50
+
+Results are printed as JSON.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from async_vs_sync import percentile  # noqa: E402
+
+# Most frequent words first; the long tail is synthetic. Word frequencies follow
+# a Zipf distribution, as they do in real chat text.
+COMMON_WORDS = (
+    'the to a is and of in it you how i for this that with python code on can '
+    'list error function use do what file data string return my not be an value '
+    'sort dict async await thread lock queue socket http json parse regex loop '
+    'class method module import exception stack memory cache index query table '
+    'join select insert update delete commit rollback rust java docker deploy '
+    'build test mock fixture recursion iterator generator closure decorator lambda'
+).split()
+VOCABULARY_SIZE = 20000
+RARE_TERMS = ['zanzibar', 'quokka', 'fjord', 'xylophone']
+MODELS = ['gpt2', 'distilgpt2', 'microsoft/DialoGPT-small', 'microsoft/DialoGPT-medium']
+
+
+def build_vocabulary(rng):
+    words = list(COMMON_WORDS)
+    while len(words) < VOCABULARY_SIZE:
+        words.append(''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(4, 9))))
+    weights = [1 / (rank + 1) ** 1.07 for rank in range(len(words))]
+    total = 0
+    cumulative = []
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    return words, cumulative
+
+
+def sentence(rng, vocabulary, words):
+    text = ' '.join(rng.choices(vocabulary[0], cum_weights=vocabulary[1], k=words))
+    if rng.random() < 0.0005:
+        text += ' ' + rng.choice(RARE_TERMS)
+    return text
+
+
+def populate(app, messages, chats, batch=20000, seed=7):
+    """Insert messages through the app schema (FTS and stats triggers included)"""
+    rng = random.Random(seed)
+    vocabulary = build_vocabulary(rng)
+    conn = app.db_pool.get_connection()
+    start = time.perf_counter()
+    for first in range(0, messages, batch):
+        rows = [
+            (f"chat_{rng.randrange(chats)}", rng.choice(MODELS), sentence(rng, vocabulary, 12), sentence(rng, vocabulary, 30))
+            for _ in range(min(batch, messages - first))
+        ]
+        with conn:
+            conn.executemany('''
+                INSERT INTO chat_messages (chat_id, model, user_message, bot_response)
+                VALUES (?, ?, ?, ?)
+            ''', rows)
+    return round(time.perf_counter() - start, 1)
+
+
+def time_calls(fn, repeat):
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    return {
+        'runs': repeat,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'max_ms': round(max(latencies) * 1000, 2)
+    }
+
+
+def like_scan(app, term, chat_id=None, limit=20):
+    """The pre-FTS alternative: newest LIKE matches (has to read every row)"""
+    conn = app.db_pool.get_connection()
+    sql = '''
+        SELECT id, chat_id, model, timestamp FROM chat_messages
+        WHERE (user_message LIKE ? OR bot_response LIKE ?)
+    '''
+    params = [f'%{term}%', f'%{term}%']
+    if chat_id:
+        sql += ' AND chat_id = ?'
+        params.append(chat_id)
+    return conn.execute(sql + ' ORDER BY timestamp DESC LIMIT ?', (*params, limit)).fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure FTS5 search latency over a large chat history')
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--chats', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=50, help='Timed runs per FTS query')
+    parser.add_argument('--like-repeat', type=int, default=3, help='Timed runs per LIKE scan (they are slow)')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    import app
+
+    cases = [
+        ('no match', 'nonexistentterm', {}),
+        ('rare term', 'quokka', {}),
+        ('mid-frequency term', 'decorator', {}),
+        ('two terms', 'async lock', {}),
+        ('prefix', 'recurs*', {}),
+        ('very common term, ranked', 'python', {}),
+        ('very common term, newest first', 'python', {'order': 'recent'}),
+        ('very common term, one chat', 'python', {'chat_id': 'chat_42'}),
+        ('two terms, one model', 'sort dict', {'model': 'gpt2'}),
+        ('mid-frequency term, deep page', 'decorator', {'offset': 500}),
+    ]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app.DATABASE_PATH = os.path.join(tmp, 'search.db')
+        app.init_database()
+        if not app.search_available:
+            print(json.dumps({'benchmark': 'fts_search', 'error': 'SQLite build lacks FTS5'}))
+            return
+        load_seconds = populate(app, args.messages, args.chats)
+
+        results = []
+        for name, text, options in cases:
+            hits, _ = app.search_messages(text, **options)
+            entry = {
+                'case': name,
+                'query': text,
+                'hits_on_page': len(hits),
+                'fts5': time_calls(lambda: app.search_messages(text, **options), args.repeat)
+            }
+            if not set(options) - {'chat_id'} and not text.endswith('*'):
+                term = text.split()[0]
+                entry['like_scan'] = time_calls(
+                    lambda: like_scan(app, term, options.get('chat_id')), args.like_repeat)
+            results.append(entry)
+
+        database_bytes = os.path.getsize(app.DATABASE_PATH)
+        app.db_pool.close_all()
+
+    print(json.dumps({
+        'benchmark': 'fts_search',
+        'messages': args.messages,
+        'chats': args.chats,
+        'load_seconds': load_seconds,
+        'database_bytes': database_bytes,
+        'results': results
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
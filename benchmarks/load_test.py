@@ -0,0 +1,260 @@
+"""Load test: drive the HTTP API at fixed concurrency and report latency percentiles.
+
+By default this starts the fake inference server and the app (on a
+threaded Werkzeug server with a throwaway database) in-process. Scenarios
+then run one after another against real HTTP:
+
+    python benchmarks/load_test.py --concurrency 16 --requests 400 --latency-ms 100 --rate-503 0.02
+
+Use --target http://host:port to load an app that is already running
+(for example a multi-worker deployment). In that case point the app at a
+fake server started separately with benchmarks/fake_hf_server.py.
+
+Results are printed as JSON (or written with --output). Pass --compare
+with an earlier result file to add per-scenario deltas, so runs can be
+compared across commits.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from async_vs_sync import percentile  # noqa: E402
+from fake_hf_server import start_in_thread  # noqa: E402
+
+SCENARIOS = ('chat', 'chat_stream', 'history', 'stats')
+PROMPTS = [
+    'Write a Python function that reverses a string.',
+    'Explain the difference between a list and a tuple.',
+    'How do I read a file line by line?',
+    'What does the yield keyword do?'
+]
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_local_app(args):
+    """Fake upstream plus the app on a background Werkzeug server; returns (base_url, fake server)"""
+    fake = start_in_thread(
+        latency=args.latency_ms / 1000,
+        token_delay=args.token_delay_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        rate_503=args.rate_503,
+        rate_429=args.rate_429,
+        seed=args.seed
+    )
+    os.environ['HF_API_BASE'] = f"{fake.base_url}/models/"
+    os.environ['HF_HUB_API_BASE'] = f"{fake.base_url}/api/models/"
+    os.environ.setdefault('HUGGINGFACE_API_KEY', 'hf_benchmark_token')
+
+    logging.disable(logging.INFO)
+    import app
+    from werkzeug.serving import make_server
+
+    app.DATABASE_PATH = os.path.join(tempfile.mkdtemp(), 'load_test.db')
+    app.init_database()
+    server = make_server('127.0.0.1', 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", fake
+
+
+class Worker:
+    """One client connection (keep-alive session) issuing scenario requests"""
+
+    def __init__(self, base_url, model, chats, rng):
+        self.base_url = base_url
+        self.model = model
+        self.chats = chats
+        self.rng = rng
+        self.session = requests.Session()
+
+    def chat(self):
+        response = self.session.post(f"{self.base_url}/api/chat", json={
+            'chat_id': f"load_{self.rng.randrange(self.chats)}",
+            'model': self.model,
+            'message': self.rng.choice(PROMPTS)
+        }, timeout=120)
+        return response.status_code, None
+
+    def chat_stream(self):
+        start = time.perf_counter()
+        first_token = None
+        with self.session.post(f"{self.base_url}/api/chat/stream", json={
+            'chat_id': f"load_{self.rng.randrange(self.chats)}",
+            'model': self.model,
+            'message': self.rng.choice(PROMPTS)
+        }, stream=True, timeout=120) as response:
+            for line in response.iter_lines():
+                if first_token is None and line.startswith(b'data:'):
+                    first_token = time.perf_counter() - start
+            return response.status_code, first_token
+
+    def history(self):
+        response = self.session.get(
+            f"{self.base_url}/api/chat/load_{self.rng.randrange(self.chats)}/history", timeout=60)
+        return response.status_code, None
+
+    def stats(self):
+        response = self.session.get(f"{self.base_url}/api/stats", timeout=60)
+        return response.status_code, None
+
+
+def run_scenario(name, base_url, args):
+    """Issue args.requests calls of one scenario from args.concurrency workers"""
+    workers = [Worker(base_url, args.model, args.chats, random.Random(args.seed + index if args.seed is not None else None))
+               for index in range(args.concurrency)]
+    local = threading.local()
+    next_worker = iter(workers)
+    assign_lock = threading.Lock()
+    statuses = {}
+    latencies = []
+    first_tokens = []
+    errors = []
+
+    def call(_):
+        worker = getattr(local, 'worker', None)
+        if worker is None:
+            with assign_lock:
+                worker = local.worker = next(next_worker)
+        start = time.perf_counter()
+        try:
+            status, first_token = getattr(worker, name)()
+        except requests.exceptions.RequestException as e:
+            errors.append(type(e).__name__)
+            return
+        latencies.append(time.perf_counter() - start)
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+        if first_token is not None:
+            first_tokens.append(first_token)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(call, range(args.requests)))
+    elapsed = time.perf_counter() - start
+
+    for worker in workers:
+        worker.session.close()
+
+    result = {
+        'scenario': name,
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'elapsed_seconds': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'status_codes': statuses,
+        'client_errors': len(errors)
+    }
+    if latencies:
+        result.update({
+            'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+            'max_ms': round(max(latencies) * 1000, 1)
+        })
+    if first_tokens:
+        result['first_token_p50_ms'] = round(percentile(first_tokens, 50) * 1000, 1)
+        result['first_token_p95_ms'] = round(percentile(first_tokens, 95) * 1000, 1)
+    return result
+
+
+def compare(results, baseline_path):
+    """Percentage change against a previous run, per scenario"""
+    with open(baseline_path) as f:
+        baseline = {entry['scenario']: entry for entry in json.load(f)['results']}
+    deltas = {}
+    for entry in results:
+        before = baseline.get(entry['scenario'])
+        if not before:
+            continue
+        deltas[entry['scenario']] = {
+            key: round((entry[key] - before[key]) / before[key] * 100, 1)
+            for key in ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms')
+            if entry.get(key) and before.get(key)
+        }
+    return deltas
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test /api/chat, history and stats')
+    parser.add_argument('--target', help='Base URL of a running app (default: start one in-process)')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help=f"Comma-separated, from {', '.join(SCENARIOS)}")
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=400, help='Requests per scenario')
+    parser.add_argument('--chats', type=int, default=50, help='Distinct chat ids to spread traffic over')
+    parser.add_argument('--model', default='gpt2')
+    parser.add_argument('--latency-ms', type=float, default=100, help='Fake upstream latency')
+    parser.add_argument('--jitter-ms', type=float, default=20)
+    parser.add_argument('--token-delay-ms', type=float, default=5)
+    parser.add_argument('--rate-503', type=float, default=0.0)
+    parser.add_argument('--rate-429', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+    parser.add_argument('--compare', help='Earlier JSON report to compute deltas against')
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    fake = None
+    base_url = args.target.rstrip('/') if args.target else None
+    if base_url is None:
+        base_url, fake = start_local_app(args)
+
+    results = [run_scenario(name, base_url, args) for name in scenarios]
+
+    report = {
+        'benchmark': 'load_test',
+        'commit': current_commit(),
+        'target': args.target or 'in-process',
+        'config': {
+            'concurrency': args.concurrency,
+            'requests_per_scenario': args.requests,
+            'chats': args.chats,
+            'model': args.model,
+            'upstream_latency_ms': args.latency_ms,
+            'upstream_jitter_ms': args.jitter_ms,
+            'rate_503': args.rate_503,
+            'rate_429': args.rate_429,
+            'seed': args.seed
+        },
+        'results': results
+    }
+    if fake is not None:
+        report['upstream'] = {'requests': fake.request_count, 'injected': fake.injected}
+    if args.compare:
+        report['delta_percent'] = compare(results, args.compare)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    if fake is not None:
+        fake.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""Offline benchmark: local micro-batching scheduler with the deterministic fake model.
+
+Concurrent clients submit prompts to a LocalInferenceEngine backed by
+FakeLocalModel. A forward pass costs --batch-ms plus --item-ms per prompt.
+Each batch size is run in turn and the script reports throughput, latency
+percentiles and the batch sizes actually formed:
+
+    python benchmarks/local_batching.py --clients 32 --requests 20 --max-batch 1,4,8,16 --max-wait-ms 10
+
+No model download or network access is needed. Results are printed as JSON.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from async_vs_sync import percentile  # noqa: E402
+
+
+def run(app, max_batch, args):
+    backend = app.FakeLocalModel(batch_ms=args.batch_ms, item_ms=args.item_ms)
+    engine = app.LocalInferenceEngine(backend, [args.model], max_batch=max_batch, max_wait=args.max_wait_ms / 1000,
+                                      queue_size=args.clients * args.requests, timeout=300)
+    latencies = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(args.clients + 1)
+
+    def client(index):
+        barrier.wait()
+        for request in range(args.requests):
+            start = time.perf_counter()
+            engine.generate(args.model, f"client {index} prompt {request}")
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    engine.stop()
+
+    stats = engine.get_stats()
+    return {
+        'max_batch': max_batch,
+        'requests': len(latencies),
+        'elapsed_seconds': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1),
+        'avg_batch_size': stats['avg_batch_size'],
+        'batches': stats['batches'],
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the local micro-batching scheduler offline')
+    parser.add_argument('--clients', type=int, default=32, help='Concurrent callers')
+    parser.add_argument('--requests', type=int, default=20, help='Prompts per caller')
+    parser.add_argument('--max-batch', default='1,4,8,16', help='Comma-separated batch sizes to compare')
+    parser.add_argument('--max-wait-ms', type=float, default=10)
+    parser.add_argument('--batch-ms', type=float, default=40, help='Fake forward pass fixed cost')
+    parser.add_argument('--item-ms', type=float, default=5, help='Fake forward pass cost per prompt')
+    parser.add_argument('--model', default='gpt2')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    import app
+
+    results = [run(app, int(size), args) for size in args.max_batch.split(',')]
+
+    print(json.dumps({
+        'benchmark': 'local_batching',
+        'clients': args.clients,
+        'requests_per_client': args.requests,
+        'max_wait_ms': args.max_wait_ms,
+        'fake_cost_ms': {'per_batch': args.batch_ms, 'per_item': args.item_ms},
+        'results': results
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""Benchmark: concurrent chat writes against 1..N hash-partitioned SQLite shards.
+
+Threads call save_chat_message for chats spread over many ids, so each
+write goes to whichever shard owns its chat. Every shard count is run on
+a fresh set of files and the script reports write throughput for each:
+
+    python benchmarks/sharding.py --threads 16 --ops 500 --shards 1,2,4,8
+
+With --synchronous FULL every commit is fsynced, which is the case where
+a single database-level write lock hurts most. Results are printed as JSON.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from async_vs_sync import percentile  # noqa: E402
+
+
+def run(app, shards, args, tmp):
+    app.DATABASE_SHARDS = shards
+    app.DATABASE_PATH = os.path.join(tmp, f"shards_{shards}.db")
+    app.init_database()
+    if args.synchronous != 'NORMAL':
+        for conn in app.shard_connections():
+            conn.execute(f'PRAGMA synchronous={args.synchronous}')
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(args.threads + 1)
+
+    def writer(index):
+        # Each pooled connection is per thread, so set the pragma on this thread's connections too
+        if args.synchronous != 'NORMAL':
+            for conn in app.shard_connections():
+                conn.execute(f'PRAGMA synchronous={args.synchronous}')
+        barrier.wait()
+        for op in range(args.ops):
+            chat_id = f"chat_{index}_{op % args.chats_per_thread}"
+            start = time.perf_counter()
+            try:
+                app.save_chat_message(chat_id, 'gpt2', f"question {op}", f"answer {op}")
+            except app.sqlite3.Error as e:
+                errors.append(str(e))
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    per_shard = [
+        conn.execute("SELECT value FROM stats_totals WHERE name = 'total_messages'").fetchone()[0]
+        for conn in app.shard_connections()
+    ]
+    app.db_pool.close_all()
+    return {
+        'shards': shards,
+        'writes': len(latencies),
+        'errors': len(errors),
+        'elapsed_seconds': round(elapsed, 3),
+        'writes_per_second': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'messages_per_shard': per_shard
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure write throughput as the shard count grows')
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--ops', type=int, default=500, help='Writes per thread')
+    parser.add_argument('--chats-per-thread', type=int, default=20)
+    parser.add_argument('--shards', default='1,2,4,8', help='Comma-separated shard counts to compare')
+    parser.add_argument('--synchronous', default='NORMAL', choices=['OFF', 'NORMAL', 'FULL'])
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    import app
+
+    # Measure the storage layer itself, not the in-memory layers in front of it
+    app.context_cache = None
+    app.write_behind = None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = [run(app, int(count), args, tmp) for count in args.shards.split(',')]
+
+    print(json.dumps({
+        'benchmark': 'sharding',
+        'threads': args.threads,
+        'ops_per_thread': args.ops,
+        'synchronous': args.synchronous,
+        'results': results
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
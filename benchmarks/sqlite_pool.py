@@ -0,0 +1,137 @@
+"""Microbenchmark: per-call sqlite3.connect vs the pooled WAL connections.
+
+Runs the chat memory read/write pattern from N concurrent threads and
+reports operations per second for both variants:
+
+    python benchmarks/sqlite_pool.py --threads 8 --ops 500
+
+Results are printed as JSON.
+"""
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def legacy_get_chat_memory(path, chat_id, limit=10):
+    """The pre-pool implementation: new connection per call"""
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT user_message, bot_response, timestamp
+        FROM chat_messages
+        WHERE chat_id = ?
+        ORDER BY timestamp DESC
+        LIMIT ?
+    ''', (chat_id, limit))
+    messages = cursor.fetchall()
+    conn.close()
+    return list(reversed(messages))
+
+
+def legacy_save_chat_message(path, chat_id, model, user_message, bot_response):
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT OR REPLACE INTO chat_sessions (id, model, last_active)
+        VALUES (?, ?, CURRENT_TIMESTAMP)
+    ''', (chat_id, model))
+    cursor.execute('''
+        INSERT INTO chat_messages (chat_id, model, user_message, bot_response)
+        VALUES (?, ?, ?, ?)
+    ''', (chat_id, model, user_message, bot_response))
+    conn.commit()
+    conn.close()
+
+
+def run_threads(threads, ops, work):
+    """Run work(thread_index, op_index) ops times on each thread; return ops/sec"""
+    errors = []
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(index):
+        barrier.wait()
+        for op in range(ops):
+            try:
+                work(index, op)
+            except sqlite3.Error as e:
+                errors.append(str(e))
+
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in pool:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in pool:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return {
+        'ops_per_second': round(threads * ops / elapsed, 1),
+        'elapsed_seconds': round(elapsed, 3),
+        'errors': len(errors)
+    }
+
+
+def bench_variant(name, threads, ops, read, write):
+    return {
+        'variant': name,
+        'write': run_threads(threads, ops, lambda t, i: write(f"chat_{t}", 'gpt2', f"question {i}", f"answer {i}")),
+        'read': run_threads(threads, ops, lambda t, i: read(f"chat_{t}"))
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare per-call and pooled SQLite access')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--ops', type=int, default=500, help='Operations per thread')
+    args = parser.parse_args()
+
+    # Measure the database path itself: the context cache would serve reads from memory and
+    # write-behind would batch writes, so neither variant would be timing its connections
+    os.environ['CONTEXT_CACHE_ENABLED'] = 'false'
+    os.environ['WRITE_BEHIND_ENABLED'] = 'false'
+    logging.disable(logging.INFO)
+    import app
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        # Baseline: fresh connection per call, default rollback journal
+        app.DATABASE_PATH = os.path.join(tmp, 'legacy.db')
+        app.init_database()
+        app.db_pool.close_all()
+        conn = sqlite3.connect(app.DATABASE_PATH)
+        conn.execute('PRAGMA journal_mode=DELETE')
+        conn.close()
+        path = app.DATABASE_PATH
+        results.append(bench_variant(
+            'per-call connect (rollback journal)', args.threads, args.ops,
+            lambda chat_id: legacy_get_chat_memory(path, chat_id),
+            lambda *row: legacy_save_chat_message(path, *row)
+        ))
+
+        # Pooled per-thread connections with WAL
+        app.DATABASE_PATH = os.path.join(tmp, 'pooled.db')
+        app.init_database()
+        results.append(bench_variant(
+            'pooled (WAL, synchronous=NORMAL)', args.threads, args.ops,
+            app.get_chat_memory, app.save_chat_message
+        ))
+        app.db_pool.close_all()
+
+    print(json.dumps({
+        'benchmark': 'sqlite_pool',
+        'threads': args.threads,
+        'ops_per_thread': args.ops,
+        'results': results
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
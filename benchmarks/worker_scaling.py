@@ -0,0 +1,121 @@
+"""Benchmark: /api/chat throughput as serve.py workers are added.
+
+Starts the fake inference server in its own process and then, for each
+worker count, a serve.py deployment with a throwaway database. Once
+/readyz passes it drives the chat scenario from load_test.py against the
+deployment, then stops it with SIGTERM (the graceful drain path):
+
+    python benchmarks/worker_scaling.py --workers 1,2,4,8 --concurrency 64 --requests 2000
+
+A single worker is bound by one interpreter lock, so expect throughput to
+grow with workers up to about the number of CPU cores. Results are printed
+as JSON.
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from load_test import run_scenario  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_ready(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(url, timeout=1).status_code == 200:
+                return
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"{url} did not become ready within {timeout}s")
+
+
+def start_fake_server(args):
+    port = free_port()
+    process = subprocess.Popen([
+        sys.executable, os.path.join(ROOT, 'benchmarks', 'fake_hf_server.py'),
+        '--port', str(port), '--latency-ms', str(args.latency_ms), '--token-delay-ms', '0'
+    ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    wait_until_ready(f"{base_url}/api/models/gpt2")
+    return process, base_url
+
+
+def run(workers, fake_url, args, tmp):
+    port = free_port()
+    env = dict(
+        os.environ,
+        HF_API_BASE=f"{fake_url}/models/",
+        HF_HUB_API_BASE=f"{fake_url}/api/models/",
+        HUGGINGFACE_API_KEY=os.environ.get('HUGGINGFACE_API_KEY', 'hf_benchmark_token'),
+        # Admission limits are per process, so they would cap each worker rather than measure it
+        ADMISSION_ENABLED='true' if args.admission else 'false'
+    )
+    process = subprocess.Popen([
+        sys.executable, os.path.join(ROOT, 'serve.py'),
+        '--host', '127.0.0.1', '--port', str(port), '--workers', str(workers),
+        '--database', os.path.join(tmp, f"workers_{workers}.db")
+    ], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        wait_until_ready(f"{base_url}/readyz")
+        run_scenario('chat', base_url, argparse.Namespace(**dict(vars(args), requests=args.concurrency)))  # Warm-up
+        result = run_scenario('chat', base_url, args)
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout=60)
+    result.pop('scenario')
+    return dict(workers=workers, shutdown_exit_code=process.returncode, **result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure chat throughput against the number of serve.py workers')
+    parser.add_argument('--workers', default='1,2,4', help='Comma-separated worker counts to compare')
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--requests', type=int, default=2000, help='Chat requests per worker count')
+    parser.add_argument('--chats', type=int, default=200, help='Distinct chat ids to spread traffic over')
+    parser.add_argument('--model', default='gpt2')
+    parser.add_argument('--latency-ms', type=float, default=20, help='Fake upstream latency')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--admission', action='store_true', help='Keep client-side admission control on in the workers')
+    args = parser.parse_args()
+
+    fake, fake_url = start_fake_server(args)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            results = [run(int(count), fake_url, args, tmp) for count in args.workers.split(',')]
+    finally:
+        fake.terminate()
+        fake.wait()
+
+    print(json.dumps({
+        'benchmark': 'worker_scaling',
+        'cpu_count': os.cpu_count(),
+        'concurrency': args.concurrency,
+        'requests': args.requests,
+        'upstream_latency_ms': args.latency_ms,
+        'admission_control': args.admission,
+        'results': results
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""Offline resharding of the chat database.
+
+Copies chat sessions, messages and summaries from one or more existing
+database files into a fresh set of shards, placing every chat with the
+same hash the app uses (app.shard_index):
+
+    python reshard.py --source ai_memory.db --shards 4
+    python reshard.py --source ai_memory-0-of-4.db ai_memory-1-of-4.db ai_memory-2-of-4.db ai_memory-3-of-4.db --shards 8
+
+Targets are named like the app names them (ai_memory-<i>-of-<n>.db next to
+--target-base), so afterwards start the app with DATABASE_SHARDS=<n>.
+Stop the app first: this tool does not coordinate with live writers.
+
+Message ids are renumbered per shard (timestamps and ordering within a chat
+are kept). Statistics, rollups and the search index are rebuilt by the
+schema triggers as rows are copied. The response cache is not copied.
+"""
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+import app
+
+BATCH_SIZE = 5000
+
+
+def copy_sessions(source, targets, shards):
+    copied = 0
+    rows = source.execute('SELECT id, model, created_at, last_active FROM chat_sessions')
+    while True:
+        batch = rows.fetchmany(BATCH_SIZE)
+        if not batch:
+            break
+        by_shard = {}
+        for row in batch:
+            by_shard.setdefault(app.shard_index(row[0], shards), []).append(row)
+        for index, shard_rows in by_shard.items():
+            with targets[index]:
+                targets[index].executemany('''
+                    INSERT INTO chat_sessions (id, model, created_at, last_active)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(id) DO UPDATE SET
+                        last_active = MAX(last_active, excluded.last_active),
+                        model = CASE WHEN excluded.last_active > last_active THEN excluded.model ELSE model END
+                ''', shard_rows)
+        copied += len(batch)
+    return copied
+
+
+def copy_messages(source, targets, shards):
+    copied = 0
+    rows = source.execute('''
+        SELECT chat_id, model, user_message, bot_response, timestamp, latency_ms
+        FROM chat_messages
+        ORDER BY id
+    ''')
+    while True:
+        batch = rows.fetchmany(BATCH_SIZE)
+        if not batch:
+            break
+        by_shard = {}
+        for row in batch:
+            by_shard.setdefault(app.shard_index(row[0], shards), []).append(row)
+        for index, shard_rows in by_shard.items():
+            with targets[index]:
+                targets[index].executemany('''
+                    INSERT INTO chat_messages (chat_id, model, user_message, bot_response, timestamp, latency_ms)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', shard_rows)
+        copied += len(batch)
+    return copied
+
+
+def copy_summaries(source, targets, shards):
+    """Summaries point at message ids, which were renumbered; translate by position within the chat"""
+    copied = 0
+    for chat_id, summary, summarized_through in source.execute(
+            'SELECT chat_id, summary, summarized_through FROM chat_summaries').fetchall():
+        position = source.execute(
+            'SELECT COUNT(*) FROM chat_messages WHERE chat_id = ? AND id <= ?', (chat_id, summarized_through)
+        ).fetchone()[0]
+        target = targets[app.shard_index(chat_id, shards)]
+        new_through = 0
+        if position:
+            row = target.execute('''
+                SELECT id FROM chat_messages WHERE chat_id = ?
+                ORDER BY id
+                LIMIT 1 OFFSET ?
+            ''', (chat_id, position - 1)).fetchone()
+            new_through = row[0] if row else 0
+        with target:
+            target.execute('''
+                INSERT OR REPLACE INTO chat_summaries (chat_id, summary, summarized_through)
+                VALUES (?, ?, ?)
+            ''', (chat_id, summary, new_through))
+        copied += 1
+    return copied
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Redistribute chat data across N SQLite shards')
+    parser.add_argument('--source', nargs='+', required=True, help='Existing database file(s), e.g. every current shard')
+    parser.add_argument('--shards', type=int, required=True, help='Number of target shards')
+    parser.add_argument('--target-base', default=app.DATABASE_PATH,
+                        help='Base path the target shard names are derived from (default: %(default)s)')
+    parser.add_argument('--force', action='store_true', help='Overwrite target files that already exist')
+    args = parser.parse_args()
+
+    if args.shards < 1:
+        parser.error('--shards must be at least 1')
+    missing = [path for path in args.source if not os.path.exists(path)]
+    if missing:
+        parser.error(f"Source not found: {', '.join(missing)}")
+
+    target_paths = app.shard_paths(args.shards, args.target_base)
+    sources = {os.path.abspath(path) for path in args.source}
+    overlap = [path for path in target_paths if os.path.abspath(path) in sources]
+    if overlap:
+        parser.error(f"Target would overwrite a source: {', '.join(overlap)} (choose another --target-base)")
+    existing = [path for path in target_paths if os.path.exists(path)]
+    if existing and not args.force:
+        parser.error(f"Target exists: {', '.join(existing)} (use --force to overwrite)")
+    for path in existing:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    logging.disable(logging.INFO)
+    pool = app.SQLiteConnectionPool()
+    targets = [pool.get_connection(path) for path in target_paths]
+    for conn in targets:
+        app.init_schema(conn)
+
+    started = time.monotonic()
+    report = {'sources': args.source, 'targets': target_paths, 'sessions': 0, 'messages': 0, 'summaries': 0}
+    for path in args.source:
+        source = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            report['sessions'] += copy_sessions(source, targets, args.shards)
+            report['messages'] += copy_messages(source, targets, args.shards)
+            report['summaries'] += copy_summaries(source, targets, args.shards)
+        finally:
+            source.close()
+
+    report['messages_per_shard'] = [
+        conn.execute("SELECT value FROM stats_totals WHERE name = 'total_messages'").fetchone()[0] for conn in targets
+    ]
+    for conn in targets:
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    pool.close_all()
+    report['duration_seconds'] = round(time.monotonic() - started, 2)
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,181 @@
+"""Production entry point: a pre-fork pool of workers serving the preloaded app.
+
+    python serve.py --workers 4 --port 5000
+
+The master imports app.py once, so configuration, model tables and the
+cached index page are shared with the workers copy-on-write. It creates
+the database schema under a file lock, binds the listening socket and forks
+the workers. Each worker runs a threaded WSGI server on the shared socket.
+Worker 0 also runs the singleton background jobs (model prober, retention);
+the other workers learn model health from their own traffic.
+
+SIGTERM or SIGINT starts a graceful drain. /readyz fails for
+--drain-delay seconds and then the workers close the listening socket, so
+new connections are refused instead of waiting in the backlog. In-flight
+requests, including upstream calls and streams, get up to
+--graceful-timeout seconds to finish. Write-behind rows are flushed and
+the workers exit. Workers that die are replaced. Unix only (uses fork).
+
+Limits kept in process memory (ADMISSION_RATE, circuit breakers) apply per
+worker, so the admission budget grows with --workers. The chat context
+cache would go stale when another worker writes or clears a chat, so it is
+turned off whenever there is more than one worker; history is then always
+read from the database. Write-behind rows are still only visible to other
+workers once flushed (WRITE_BEHIND_FLUSH_MS).
+
+Other WSGI servers can import app:app directly: the schema is then created
+on the first request, under the same lock. If they preload the app before
+forking, call app.init_worker() in each worker, which also turns the
+context cache off. If they run several worker processes without
+preloading (gunicorn -w 4 app:app), set CONTEXT_CACHE_ENABLED=false.
+"""
+import argparse
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+from werkzeug.serving import make_server
+
+import app
+
+logger = logging.getLogger('serve')
+
+
+def run_worker(index, sock, args):
+    """Body of a forked worker; never returns"""
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The master turns Ctrl-C into SIGTERM for everyone
+
+    app.init_worker(index, single_process=args.workers == 1)
+    server = make_server(args.host, args.port, app.app, threaded=True, fd=sock.fileno())
+    sock.close()  # The server holds its own duplicate; keep one descriptor per worker so drain can close it
+    server.socket.setblocking(False)  # Workers share the socket; losing an accept race must not block
+    threading.Thread(target=server.serve_forever, name='http', daemon=True).start()
+    logger.info(f"Worker {index} (pid {os.getpid()}) serving")
+
+    while not stop.wait(1):
+        pass
+
+    app.lifecycle.begin_drain()
+    if args.drain_delay > 0:
+        time.sleep(args.drain_delay)  # Let load balancers see /readyz fail before the listener goes away
+    server.shutdown()
+    server.server_close()  # Once every process has closed the listener, new connections are refused at once
+    idle = app.lifecycle.wait_idle(args.graceful_timeout)
+    if not idle:
+        logger.warning(f"Worker {index} exiting with {app.lifecycle.inflight} request(s) still in flight")
+    app.shutdown_services()
+    logger.info(f"Worker {index} (pid {os.getpid()}) stopped")
+    logging.shutdown()
+    os._exit(0 if idle else 1)
+
+
+def spawn(index, sock, args):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            run_worker(index, sock, args)
+        except BaseException:
+            logger.exception(f"Worker {index} crashed")
+        finally:
+            os._exit(1)
+    return pid
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the app with pre-forked workers')
+    parser.add_argument('--host', default=os.environ.get('HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 5000)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 1)))
+    parser.add_argument('--graceful-timeout', type=float, default=float(os.environ.get('GRACEFUL_TIMEOUT', 30)),
+                        help='Seconds in-flight requests get to finish on shutdown')
+    parser.add_argument('--drain-delay', type=float, default=float(os.environ.get('DRAIN_DELAY', 0)),
+                        help='Seconds to fail /readyz before closing the listener')
+    parser.add_argument('--backlog', type=int, default=2048)
+    parser.add_argument('--database', help=f"Database path (default: {app.DATABASE_PATH})")
+    parser.add_argument('--access-log', action='store_true', help='Log every request')
+    args = parser.parse_args()
+
+    if not hasattr(os, 'fork'):
+        parser.error('Pre-forking needs os.fork; use python app.py on this platform')
+    if not args.access_log:
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    if args.database:
+        app.DATABASE_PATH = args.database
+    if not app.HF_API_KEY:
+        logger.warning("WARNING: HUGGINGFACE_API_KEY not set! Set it with: export HUGGINGFACE_API_KEY='your_token'")
+
+    # Schema setup happens once, here; workers find it done
+    app.ensure_database()
+    # Nothing a child cannot use may cross the fork: connections, or the import-time write-behind thread
+    if app.write_behind is not None:
+        app.write_behind.stop()
+    app.db_pool.close_all()
+
+    sock = socket.create_server((args.host, args.port), backlog=args.backlog)
+    sock.setblocking(False)
+    port = sock.getsockname()[1]
+    args.port = port
+
+    workers = {}  # pid -> worker index
+    for index in range(args.workers):
+        workers[spawn(index, sock, args)] = index
+    logger.info(f"Serving on http://{args.host}:{port} with {args.workers} worker(s) (master pid {os.getpid()})")
+
+    stopping = threading.Event()
+
+    def request_stop(signum, frame):
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    while not stopping.is_set():
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            pid = 0
+        if pid and pid in workers:
+            index = workers.pop(pid)
+            logger.warning(f"Worker {index} (pid {pid}) exited with status {os.waitstatus_to_exitcode(status)}; restarting")
+            time.sleep(1)  # Don't spin if workers crash on startup
+            if not stopping.is_set():
+                workers[spawn(index, sock, args)] = index
+            continue
+        stopping.wait(0.2)
+
+    sock.close()  # Workers hold their own copies until their drain delay is over
+    logger.info(f"Draining {len(workers)} worker(s) (up to {args.graceful_timeout + args.drain_delay:.0f}s)")
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    deadline = time.monotonic() + args.graceful_timeout + args.drain_delay + 5
+    exit_code = 0
+    while workers and time.monotonic() < deadline:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid:
+            workers.pop(pid, None)
+            exit_code = exit_code or os.waitstatus_to_exitcode(status)
+        else:
+            time.sleep(0.1)
+    for pid in workers:
+        logger.warning(f"Worker pid {pid} did not stop in time; killing it")
+        os.kill(pid, signal.SIGKILL)
+        exit_code = 1
+    logger.info('Shut down')
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())